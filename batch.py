@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from camera_provisioner import LOG_FORMAT, LOG_LEVEL, apply_plan, make_plan
+from eventlog import log_event, setup_logging, stop_logging
+from networkswitch import expand_ip_range, get_camera_ip_range
+
+# a node manifest may come with <manifest>.credentials.json holding environment variables
+# of the node, e.g., WAGGLE_CAMERA_ADMIN_PASSWORD, WAGGLE_CAMERA_IP_RANGE and KUBECONFIG
+CREDENTIALS_SUFFIX = ".credentials.json"
+
+
+def find_node_manifests(batch_dir) -> list:
+    """Returns a sorted list of node name and paths of its manifest and credentials
+
+    Every file in batch_dir is a node manifest except hidden files and credentials files.
+    """
+    nodes = []
+    for name in sorted(os.listdir(batch_dir)):
+        path = os.path.join(batch_dir, name)
+        if name.startswith(".") or name.endswith(CREDENTIALS_SUFFIX) or not os.path.isfile(path):
+            continue
+        credentials_path = path + CREDENTIALS_SUFFIX
+        if not os.path.exists(credentials_path):
+            credentials_path = ""
+        nodes.append({"node": name, "manifest": path, "credentials": credentials_path})
+    return nodes
+
+
+def load_node_env(node:dict) -> dict:
+    """Returns environment variables of the node from its credentials file"""
+    if node["credentials"] == "":
+        return {}
+    with open(node["credentials"], "r") as file:
+        return {k: str(v) for k, v in json.load(file).items()}
+
+
+def check_nodes(nodes:list) -> list:
+    """Returns reasons the nodes cannot be provisioned together; empty if they can
+
+    Nodes must not scan overlapping camera IP ranges, or they would configure the same
+    cameras. Nodes without WAGGLE_CAMERA_IP_RANGE scan the default range of
+    `get_camera_ip_range`. Each node needs its own KUBECONFIG; otherwise, the datashim
+    of the node would be written to the cluster of the controller.
+    """
+    errors = []
+    ranges = []
+    kubeconfigs = {}
+    for node in nodes:
+        env = load_node_env(node)
+        ip_range = env.get("WAGGLE_CAMERA_IP_RANGE", get_camera_ip_range())
+        try:
+            addresses = expand_ip_range(ip_range)
+        except ValueError as e:
+            errors.append(f'{node["node"]}: {str(e)}')
+            continue
+        for other, other_range, other_addresses in ranges:
+            if len(addresses & other_addresses) > 0:
+                errors.append(f'{node["node"]}: camera IP range {ip_range} overlaps {other_range} of {other}')
+        ranges.append((node["node"], ip_range, addresses))
+        kubeconfig = env.get("KUBECONFIG", "")
+        if kubeconfig == "":
+            errors.append(f'{node["node"]}: no KUBECONFIG in the credentials')
+            continue
+        kubeconfig = os.path.realpath(kubeconfig)
+        if kubeconfig in kubeconfigs:
+            errors.append(f'{node["node"]}: KUBECONFIG {kubeconfig} is also used by {kubeconfigs[kubeconfig]}')
+        kubeconfigs.setdefault(kubeconfig, node["node"])
+    return errors
+
+
+def create_result(node:dict, error="") -> dict:
+    return {
+        "node": node["node"],
+        "manifest": node["manifest"],
+        "exit_code": 1,
+        "cameras": 0,
+        "configured": 0,
+        "failed_cameras": [],
+        "blurry_cameras": [],
+        "duration": 0,
+        "error": error,
+    }
+
+
+def update_result(result:dict, plan:dict, pending:list):
+    """Counts cameras of the plan into the result of the node
+
+    Only cameras that had actions and were applied count as configured; apply_plan
+    clears the actions of a camera once they are executed.
+    """
+    cameras = plan["cameras"]
+    result["cameras"] = len(cameras)
+    result["configured"] = len([
+        c for c in cameras
+        if c["ip"] in pending and c["state"] == "configured" and len(c["actions"]) == 0
+    ])
+    result["failed_cameras"] = [c["ip"] for c in cameras if c["state"] == "error"]
+    result["blurry_cameras"] = [
+        c["ip"] for c in cameras
+        if c.get("focus", None) is not None and not c["focus"]["focused"]
+    ]
+
+
+def run_node(node:dict, out_dir):
+    """Plans and applies provisioning of cameras of a node
+
+    This runs in its own process so that credentials given as environment variables,
+    module state and logging of the node are isolated from other nodes. The plan and
+    camera artifacts are stored under out_dir.
+
+    Keyword Arguments:
+    --------
+    `node` -- a dict returned from `find_node_manifests`
+
+    `out_dir` -- Directory path where the plan, the plan after applying and camera artifacts of the node will be stored
+
+    Returns:
+    --------
+    `result` -- a dict with the exit code, camera counts, duration and error of the node;
+    configured counts only the cameras configured by actions of the plan
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # worker processes are reused across nodes; restore the environment when done
+    environ = dict(os.environ)
+    setup_logging(LOG_LEVEL, LOG_FORMAT)
+    result = create_result(node)
+    plan = None
+    pending = []
+    start = time.monotonic()
+    try:
+        os.environ.update(load_node_env(node))
+        os.environ["CAMERA_ARTIFACTS_DIR"] = out_dir
+        os.environ["CAMERA_REGISTRY_PATH"] = os.path.join(out_dir, "camera_registry.json")
+        plan = make_plan(node["manifest"])
+        if plan == None:
+            result["error"] = "failed to make provisioning plan"
+            return result
+        with open(os.path.join(out_dir, "plan.json"), "w") as file:
+            json.dump(plan, file, indent=4)
+        pending = [c["ip"] for c in plan["cameras"] if len(c["actions"]) > 0]
+        result["exit_code"] = apply_plan(plan)
+    except Exception as e:
+        logging.error(f'{node["node"]}: {str(e)}')
+        result["error"] = str(e)
+    finally:
+        # counted even if applying failed halfway so that the report keeps the work done
+        if plan != None:
+            update_result(result, plan, pending)
+            with open(os.path.join(out_dir, "applied_plan.json"), "w") as file:
+                json.dump(plan, file, indent=4)
+        result["duration"] = round(time.monotonic() - start, 3)
+        log_event(
+            "node",
+            "ok" if result["exit_code"] == 0 else "error",
+            node=node["node"],
+            duration=result["duration"],
+        )
+        stop_logging()
+        os.environ.clear()
+        os.environ.update(environ)
+    return result
+
+
+def summarize(results:list, duration, workers) -> dict:
+    """Aggregates results of nodes into throughput and failures of the batch"""
+    configured = sum(r["configured"] for r in results)
+    return {
+        "workers": workers,
+        "duration": round(duration, 3),
+        "nodes": len(results),
+        "failed_nodes": [r["node"] for r in results if r["exit_code"] != 0],
+        "cameras": sum(r["cameras"] for r in results),
+        "configured": configured,
+        "failed_cameras": {r["node"]: r["failed_cameras"] for r in results if len(r["failed_cameras"]) > 0},
+        "blurry_cameras": {r["node"]: r["blurry_cameras"] for r in results if len(r["blurry_cameras"]) > 0},
+        "cameras_per_hour": round(configured * 3600 / duration, 1) if duration > 0 else 0,
+        "results": results,
+    }
+
+
+def run_batch(batch_dir, out_dir, workers=4):
+    """Provisions cameras of nodes in batch_dir with a bounded pool of worker processes
+
+    Keyword Arguments:
+    --------
+    `batch_dir` -- Directory path of node manifests
+
+    `out_dir` -- Directory path where a directory per node and the batch report will be stored
+
+    `workers` -- the number of nodes provisioned at the same time
+
+    Returns:
+    --------
+    `report` -- a dict returned from `summarize`; None if the nodes cannot be provisioned together
+    """
+    nodes = find_node_manifests(batch_dir)
+    errors = check_nodes(nodes)
+    if len(errors) > 0:
+        for error in errors:
+            logging.error(error)
+        logging.error("set WAGGLE_CAMERA_IP_RANGE and KUBECONFIG per node. Exiting...")
+        return None
+    logging.info(f"provisioning {len(nodes)} nodes from {batch_dir} with {workers} workers")
+    start = time.monotonic()
+    # spawn so that workers do not inherit threads and credentials of other nodes
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(run_node, node, os.path.join(out_dir, node["node"]))
+            for node in nodes
+        ]
+        results = []
+        for node, future in zip(nodes, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error(f'{node["node"]}: worker failed: {str(e)}')
+                results.append(create_result(node, error=str(e)))
+    report = summarize(results, time.monotonic() - start, workers)
+    with open(os.path.join(out_dir, "batch_report.json"), "w") as file:
+        json.dump(report, file, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    setup_logging(LOG_LEVEL, LOG_FORMAT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("batch_dir", help="directory of node manifests")
+    parser.add_argument("--out-dir", default="/data/batch", help="directory to store plans, artifacts and the report")
+    parser.add_argument("--workers", type=int, default=4, help="the number of nodes provisioned at the same time")
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    report = run_batch(args.batch_dir, args.out_dir, args.workers)
+    if report == None:
+        exit(1)
+    print(json.dumps({k: v for k, v in report.items() if k != "results"}, indent=4))
+    exit(0 if len(report["failed_nodes"]) == 0 else 1)
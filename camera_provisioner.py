@@ -1,23 +1,48 @@
 #!/usr/bin/env python3
+import argparse
+import copy
 import os
 import json
 import logging
 import os
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import kubernetes
 
-from hanwhacamera import get_camera_credential, update_hanwha_camera
+from hanwhacamera import (
+    DESIRED_CAMERA_PROFILE,
+    apply_hanwha_camera_plan,
+    audit_hanwha_cameras,
+    get_camera_credential,
+    plan_hanwha_cameras,
+)
 from networkswitch import (
     get_cameras_from_nmap,
     get_networkswitch_credential,
     get_ports_from_switch,
 )
 import utils
+from eventlog import setup_logging, timed_event
 
 WAGGLE_MANIFEST_V2_PATH = os.getenv("WAGGLE_MANIFEST_V2_PATH", "")
 
+# the number of cameras inspected or provisioned at the same time
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+
+# namespaces other than default that get the datashim when they exist
+DATASHIM_NAMESPACES = ["ses", "dev"]
+
+# LOG_LEVEL=DEBUG logs every camera row, which is expensive, in addition to events
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# json for one JSON line per log record; text for plain text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# a JSON file overriding hanwhacamera.DESIRED_CAMERA_PROFILE for the drift audit
+CAMERA_PROFILE_PATH = os.getenv("CAMERA_PROFILE_PATH", "")
+
 TARGET_CAMERA_REGEX = os.getenv("TARGET_CAMERA_REGEX", [
     {
         "description": "hanwha cameras",
@@ -104,15 +129,23 @@ def get_configmap(api, name, namespace="default"):
     return None
 
 
-def set_datashim(api, datashim, name, namespace="default"):
-    configmap = get_configmap(api, name, namespace)
-    if configmap == None:
+def set_datashim(api, datashim, name, namespace="default", resource_version=None):
+    """Writes the datashim into the Kubernetes Configmap
+
+    Without resource_version the Configmap is created, which fails if it already exists.
+    With resource_version the Configmap is patched only if it has not changed since then.
+    Either way, kubernetes.client.rest.ApiException with status 409 is raised on conflict.
+    """
+    if resource_version == None:
         configmap = kubernetes.client.V1ConfigMap()
         configmap.metadata = kubernetes.client.V1ObjectMeta(name=name)
         configmap.data = {"data-config.json": json.dumps(datashim, indent=4)}
         api.create_namespaced_config_map(namespace, configmap)
     else:
-        patch = {"data": {"data-config.json": json.dumps(datashim, indent=4)}}
+        patch = {
+            "metadata": {"resourceVersion": resource_version},
+            "data": {"data-config.json": json.dumps(datashim, indent=4)},
+        }
         api.patch_namespaced_config_map(name, namespace, patch)
 
 
@@ -124,6 +157,9 @@ def temp_update_manifest_cameras(manifest_cameras, node_cameras):
         if camera["state"] != "configured":
             logging.info(f'skipping {camera["ip"]} because of the wrong state "{camera["state"]}", expected "configured"')
             continue
+        if orientation == "":
+            logging.info(f'skipping {camera["ip"]} because it has no orientation')
+            continue
         for m_camera in manifest_cameras:
             if orientation in m_camera.name:
                 logging.info(f"the camera for {orientation} found. datashim will be updated")
@@ -166,28 +202,66 @@ def drop_camera_from_datashim(datashim, camera):
     return datashim
 
 
-def update_datashim(manifest_cameras:list):
-    """Updates the datashim Kubernetes Configmap based on camera status
+@contextmanager
+def quiet_kubernetes_logging():
+    # NOTE: Debug messages from Kubernetes client may contain sensitive information
+    #       and thus disable debugging flag on the loggers of the client only
+    loggers = [logging.getLogger(name) for name in ["kubernetes", "urllib3"]]
+    logger_levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(max(logger.getEffectiveLevel(), logging.INFO))
+    try:
+        yield
+    finally:
+        for logger, level in zip(loggers, logger_levels):
+            logger.setLevel(level)
+
+
+def get_kubernetes_api():
+    # KUBECONFIG points to the cluster of the node when running outside of the node
+    kubeconfig = os.getenv("KUBECONFIG", "")
+    if kubeconfig != "":
+        kubernetes.config.load_kube_config(config_file=kubeconfig)
+    else:
+        kubernetes.config.load_incluster_config()
+    return kubernetes.client.CoreV1Api()
+
 
-    This updates the datashim on "ses" namespace as well to affect plugins running in
-    the namespace.
+def get_datashim(api, name, namespace="default"):
+    """Returns the datashim stored in the Kubernetes Configmap and the resourceVersion of the Configmap
 
-    Keyword Arguments:
-    --------
-    `manifest_cameras` -- a list of utils.CameraObject that are configured
+    Both are None if the Configmap does not exist.
     """
-    # NOTE: Debug messages from Kubernetes client may contain sensitive information
-    #       and thus disable debugging flag
-    logger_level = logging.getLogger().level
-    logging.getLogger().setLevel(logging.INFO)
-    kubernetes.config.load_incluster_config()
-    api = kubernetes.client.CoreV1Api()
-    configmap = get_configmap(api, "waggle-data-config")
+    configmap = get_configmap(api, name, namespace)
     if configmap == None:
-        logging.warning("not found waggle-data-config in default namespace")
-        datashim = []
-    else:
-        datashim = json.loads(configmap.data["data-config.json"])
+        return None, None
+    return json.loads(configmap.data["data-config.json"]), configmap.metadata.resource_version
+
+
+def get_datashims(api, name="waggle-data-config"):
+    """Reads the datashim from default namespace and the namespaces datashim is applied to
+
+    Returns:
+    --------
+    `datashims` -- a dict of namespace and its datashim; None if the datashim does not exist
+
+    `resource_versions` -- a dict of namespace and resourceVersion of its Configmap; None if the datashim does not exist
+    """
+    namespaces = ["default"]
+    existing_namespaces = api.list_namespace()
+    for namespace in existing_namespaces.items:
+        if namespace.metadata.name in DATASHIM_NAMESPACES:
+            namespaces.append(namespace.metadata.name)
+    datashims = {}
+    resource_versions = {}
+    for namespace in namespaces:
+        datashims[namespace], resource_versions[namespace] = get_datashim(api, name, namespace)
+    return datashims, resource_versions
+
+
+def build_datashim(datashim, manifest_cameras:list):
+    """Returns a new datashim with camera entries updated based on camera status"""
+    datashim = copy.deepcopy(datashim)
     for camera in manifest_cameras:
         if camera.state != "registered":
             logging.info(f"dropping datashim for {camera.name}...")
@@ -195,47 +269,158 @@ def update_datashim(manifest_cameras:list):
             continue
         logging.info(f"updating datashim for {camera.name}...")
         datashim = update_datashim_for_camera(datashim, camera)
-    set_datashim(api, datashim, "waggle-data-config")
-    namespaces_to_apply = ["ses", "dev"]
-    existing_namespaces = api.list_namespace()
-    for namespace in existing_namespaces.items:
-        if namespace.metadata.name in namespaces_to_apply:
-            logging.info(f"applying datashim to {namespace.metadata.name}...")
-            set_datashim(api, datashim, "waggle-data-config", namespace=namespace.metadata.name)
-    logging.getLogger().setLevel(logger_level)
-    return manifest_cameras
+    return datashim
 
 
-def run():
-    logging.info(f'get node manifest from {WAGGLE_MANIFEST_V2_PATH}')
-    if not os.path.exists(WAGGLE_MANIFEST_V2_PATH):
-        logging.error(f"no {WAGGLE_MANIFEST_V2_PATH} found. Exiting.")
-        return 1
-    camera_matchers = utils.create_object_matchers(TARGET_CAMERA_REGEX)
-    manifest_cameras = get_cameras_from_manifest(WAGGLE_MANIFEST_V2_PATH, camera_matchers)
-    if len(manifest_cameras) < 1:
-        logging.info(f'no matching camera found. no further action will be taken.')
-        return 0
-    else:
-        logging.info(f"found {len(manifest_cameras)} cameras from manifest")
+def get_datashim_entry_name(entry):
+    try:
+        return entry["match"]["id"]
+    except KeyError:
+        return entry.get("name", "")
+
+
+def diff_datashim(current, target) -> dict:
+    """Returns names of datashim entries added, updated and removed from current to target"""
+    current_entries = {get_datashim_entry_name(e): e for e in current}
+    target_entries = {get_datashim_entry_name(e): e for e in target}
+    return {
+        "added": [n for n in target_entries if n not in current_entries],
+        "updated": [
+            n for n in target_entries
+            if n in current_entries and current_entries[n] != target_entries[n]
+        ],
+        "removed": [n for n in current_entries if n not in target_entries],
+    }
 
-    logging.info('fetching network switch credential.')
-    if not all(get_networkswitch_credential()):
-        logging.error("could not get network switch credential. Exiting...")
-        return 1
 
-    logging.info('fetching camera user credential.')
-    if not all(get_camera_credential()):
-        logging.error("could not get camera credentials. Exiting...")
-        return 1
+def plan_datashim(datashims:dict, manifest_cameras:list, resource_versions={}) -> dict:
+    """Computes the datashim to apply and the changes in each namespace
+
+    The datashim in default namespace is the base of the datashim applied to all namespaces.
+    The resourceVersion of each Configmap is recorded so that the datashim is not applied
+    over changes made after the plan.
+
+    Keyword Arguments:
+    --------
+    `datashims` -- a dict of namespace and its current datashim returned from `get_datashims`
+
+    `manifest_cameras` -- a list of utils.CameraObject
+
+    `resource_versions` -- a dict of namespace and resourceVersion of its Configmap returned from `get_datashims`
+
+    Returns:
+    --------
+    `datashim_plan` -- a dict with the datashim to apply and the changes per namespace
+    """
+    base = datashims.get("default", None)
+    if base == None:
+        logging.warning("not found waggle-data-config in default namespace")
+        base = []
+    target = build_datashim(base, manifest_cameras)
+    namespaces = {}
+    for namespace, current in datashims.items():
+        changes = diff_datashim(current or [], target)
+        changes["exists"] = current != None
+        changes["resource_version"] = resource_versions.get(namespace, None)
+        namespaces[namespace] = changes
+    return {"data": target, "namespaces": namespaces}
+
+
+def has_datashim_changes(changes:dict) -> bool:
+    if not changes["exists"]:
+        return True
+    return any(len(changes[k]) > 0 for k in ["added", "updated", "removed"])
 
+
+def apply_datashim(api, datashim_plan:dict, name="waggle-data-config") -> list:
+    """Applies the datashim to namespaces that have changes in the plan
+
+    A namespace whose Configmap changed after the plan is not applied. Applied
+    namespaces are marked with "applied" in their changes.
+
+    Returns:
+    --------
+    `conflicts` -- a list of namespaces not applied because of conflict
+    """
+    conflicts = []
+    for namespace, changes in datashim_plan["namespaces"].items():
+        if not has_datashim_changes(changes):
+            logging.info(f"datashim in {namespace} is up to date. skipping.")
+            continue
+        logging.info(f"applying datashim to {namespace}...")
+        try:
+            with timed_event("datashim", namespace=namespace):
+                set_datashim(
+                    api, datashim_plan["data"], name, namespace=namespace,
+                    resource_version=changes["resource_version"],
+                )
+            changes["applied"] = True
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 409:
+                raise
+            logging.error(f"datashim in {namespace} changed after the plan was made. not applied")
+            conflicts.append(namespace)
+    return conflicts
+
+
+def save_datashim_cameras(datashim, camera_names:list, namespaces:list) -> dict:
+    """Saves datashim entries of the cameras as the last known-good camera registry of the namespaces
+
+    The registry is used by datashimguard.py to restore camera entries changed by others.
+    Entries of other namespaces are kept.
+
+    Returns:
+    --------
+    `previous` -- the registry before saving, to restore namespaces that are not applied
+    """
+    entries = [e for e in datashim if get_datashim_entry_name(e) in camera_names]
+    registry_path = utils.get_camera_registry_path()
+    try:
+        previous = utils.load_camera_registry(registry_path)
+        registry = dict(previous)
+        registry.update({n: entries for n in namespaces})
+        utils.save_camera_registry(registry_path, registry)
+    except (OSError, ValueError) as e:
+        logging.warning(f"failed to save camera registry to {registry_path}: {str(e)}")
+        return {}
+    return previous
+
+
+def restore_datashim_cameras(previous:dict, namespaces:list):
+    """Restores the camera registry of the namespaces to the previous one"""
+    registry_path = utils.get_camera_registry_path()
+    try:
+        registry = utils.load_camera_registry(registry_path)
+        for namespace in namespaces:
+            if namespace in previous:
+                registry[namespace] = previous[namespace]
+            else:
+                registry.pop(namespace, None)
+        utils.save_camera_registry(registry_path, registry)
+    except (OSError, ValueError) as e:
+        logging.warning(f"failed to restore camera registry in {registry_path}: {str(e)}")
+
+
+def read_datashims():
+    with quiet_kubernetes_logging():
+        return get_datashims(get_kubernetes_api())
+
+
+def discover_cameras(manifest_path):
+    with timed_event("discover") as event:
+        node_cameras = _discover_cameras(manifest_path)
+        event["cameras"] = len(node_cameras)
+    return node_cameras
+
+
+def _discover_cameras(manifest_path):
     logging.info("scanning cameras using nmap...")
     cameras_from_nmap = get_cameras_from_nmap()
     logging.info("sleep 3 seconds for the switch to update its network table")
     time.sleep(3)
-    if utils.does_networkswitch_exist(WAGGLE_MANIFEST_V2_PATH):
+    if utils.does_networkswitch_exist(manifest_path):
         try:
-            # PL 01.02.2024 
+            # PL 01.02.2024
             # Added logic to first try getting ports from the switch via config specified IP
             # and if it fails, fallback on the cameras_from_nmap
             node_cameras = get_ports_from_switch(cameras_from_nmap)
@@ -249,33 +434,251 @@ def run():
     else:
         node_cameras = cameras_from_nmap
         logging.info('network switch does not exist in manifest. skip getting information on switch port for cameras')
-    logging.debug("updated state of cameras:")
-    for _, c in node_cameras.iterrows():
-        logging.debug(c)
-    # logging.info('Scanning cameras using network switch...')
-    # cameras_from_switch = get_cameras_from_switch()
-    # logging.debug(f'Cameras found from networkswitch: {cameras_from_switch}')
-
-    logging.info("updating or provisioning Hanwha cameras...")
-    node_cameras = update_hanwha_camera(node_cameras)
-    logging.debug("updated state of cameras:")
-    for _, c in node_cameras.iterrows():
-        logging.debug(c)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("updated state of cameras:")
+        for _, c in node_cameras.iterrows():
+            logging.debug(c)
+    return node_cameras
+
 
+def register_manifest_cameras(manifest_cameras, camera_plans):
     # TODO(Yongho): this uses hardcoded names. We should use camera's serial_no to match between
     # the manifest cameras and node cameras
+    node_cameras = utils.create_dataframe(camera_plans)
     manifest_cameras = temp_update_manifest_cameras(manifest_cameras, node_cameras)
     for m_c in manifest_cameras:
         if m_c.url != "" and m_c.state != "registered":
             logging.info(f'we will register {m_c.name} as it has its url {m_c.url} already set')
             m_c.set_state("registered")
-    cameras = update_datashim(manifest_cameras)
+    return manifest_cameras
+
+
+def make_plan(manifest_path):
+    """Computes the provisioning plan without changing cameras or datashim
+
+    Discovery of cameras and reading datashim from Kubernetes run in parallel. Then,
+    cameras are inspected in parallel using read-only calls.
+
+    Keyword Arguments:
+    --------
+    `manifest_path` -- a path to node-manifest-v2.json
+
+    Returns:
+    --------
+    `plan` -- a JSON serializable dict with actions per camera and datashim changes per namespace; None if the plan could not be made
+    """
+    logging.info(f'get node manifest from {manifest_path}')
+    if not os.path.exists(manifest_path):
+        logging.error(f"no {manifest_path} found. Exiting.")
+        return None
+    plan = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "manifest": manifest_path,
+        "cameras": [],
+        "manifest_cameras": [],
+        "datashim": None,
+    }
+    camera_matchers = utils.create_object_matchers(TARGET_CAMERA_REGEX)
+    manifest_cameras = get_cameras_from_manifest(manifest_path, camera_matchers)
+    if len(manifest_cameras) < 1:
+        logging.info(f'no matching camera found. no further action will be taken.')
+        return plan
+    else:
+        logging.info(f"found {len(manifest_cameras)} cameras from manifest")
+
+    logging.info('fetching network switch credential.')
+    if not all(get_networkswitch_credential()):
+        logging.error("could not get network switch credential. Exiting...")
+        return None
+
+    logging.info('fetching camera user credential.')
+    if not all(get_camera_credential()):
+        logging.error("could not get camera credentials. Exiting...")
+        return None
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        discovery = executor.submit(discover_cameras, manifest_path)
+        datashims = executor.submit(read_datashims)
+        node_cameras = discovery.result()
+        datashims, resource_versions = datashims.result()
+
+    logging.info("inspecting Hanwha cameras...")
+    camera_plans = plan_hanwha_cameras(node_cameras, max_workers=MAX_WORKERS)
+    manifest_cameras = register_manifest_cameras(manifest_cameras, camera_plans)
+    plan["cameras"] = camera_plans
+    plan["manifest_cameras"] = [vars(c) for c in manifest_cameras]
+    plan["datashim"] = plan_datashim(datashims, manifest_cameras, resource_versions)
+    return plan
+
+
+def apply_plan(plan:dict):
+    """Executes the provisioning plan made by `make_plan`
+
+    Only the actions in the plan are executed. Cameras in factory default state can only
+    be resolved after initialization, so their datashim entries are added to the plan
+    before the datashim is applied. The datashim is not applied to namespaces whose
+    Configmap changed after the plan was made.
+
+    Keyword Arguments:
+    --------
+    `plan` -- a dict returned from `make_plan`
+
+    Returns:
+    --------
+    `exit_code` -- 0 if succeeded
+    """
+    if plan["datashim"] == None:
+        logging.info("nothing to apply.")
+        return 0
+    pending = [c for c in plan["cameras"] if len(c["actions"]) > 0]
+    if len(pending) > 0:
+        logging.info('fetching camera user credential.')
+        if not all(get_camera_credential()):
+            logging.error("could not get camera credentials. Exiting...")
+            return 1
+        logging.info(f"updating or provisioning {len(pending)} Hanwha cameras...")
+        camera_plans = apply_hanwha_camera_plan(plan["cameras"], max_workers=MAX_WORKERS)
+        initialized = [
+            c for c, p in zip(camera_plans, plan["cameras"])
+            if "initialize" in p["actions"] and c["state"] == "configured"
+        ]
+        if len(initialized) > 0:
+            manifest_cameras = []
+            for m in plan["manifest_cameras"]:
+                c = utils.CameraObject(m["name"], m["manufacturer"], m["hw_model"])
+                c.__dict__.update(m)
+                manifest_cameras.append(c)
+            before = {c.name: (c.state, c.url) for c in manifest_cameras}
+            manifest_cameras = temp_update_manifest_cameras(
+                manifest_cameras, utils.create_dataframe(initialized)
+            )
+            for m_c in manifest_cameras:
+                if before[m_c.name] == (m_c.state, m_c.url):
+                    continue
+                logging.info(f"updating datashim for {m_c.name}...")
+                update_datashim_for_camera(plan["datashim"]["data"], m_c)
+                for changes in plan["datashim"]["namespaces"].values():
+                    if m_c.name not in changes["added"] + changes["updated"]:
+                        changes["updated"].append(m_c.name)
+        plan["cameras"] = camera_plans
+    # the registry is saved first so that datashimguard.py never sees the new camera
+    # entries in the datashim while it still holds the old registry; namespaces not
+    # applied get their previous registry back so that the guard does not force them
+    namespaces = plan["datashim"]["namespaces"]
+    previous = save_datashim_cameras(
+        plan["datashim"]["data"], [m["name"] for m in plan["manifest_cameras"]], list(namespaces)
+    )
+    try:
+        with quiet_kubernetes_logging():
+            conflicts = apply_datashim(get_kubernetes_api(), plan["datashim"])
+    finally:
+        refused = [
+            n for n, changes in namespaces.items()
+            if has_datashim_changes(changes) and not changes.get("applied", False)
+        ]
+        if len(refused) > 0:
+            restore_datashim_cameras(previous, refused)
+    if len(conflicts) > 0:
+        logging.error(f"datashim in {conflicts} was not applied. make a new plan")
+        return 1
     return 0
 
 
-logging.basicConfig(
-    level=logging.DEBUG, format="%(asctime)s %(message)s", datefmt="%Y/%m/%d %H:%M:%S"
-)
+def load_camera_profile(profile_path) -> dict:
+    profile = dict(DESIRED_CAMERA_PROFILE)
+    if profile_path != "":
+        logging.info(f'loading camera profile from {profile_path}')
+        with open(profile_path, "r") as file:
+            profile.update(json.load(file))
+    return profile
+
+
+def audit(manifest_path):
+    """Audits cameras found in the node against the desired state profile
+
+    No change is made on cameras. Cameras are audited in parallel.
+
+    Keyword Arguments:
+    --------
+    `manifest_path` -- a path to node-manifest-v2.json
+
+    Returns:
+    --------
+    `report` -- a JSON serializable dict with drift reports per camera; None if the audit could not be made
+    """
+    if not os.path.exists(manifest_path):
+        logging.error(f"no {manifest_path} found. Exiting.")
+        return None
+    logging.info('fetching camera user credential.')
+    if not all(get_camera_credential()):
+        logging.error("could not get camera credentials. Exiting...")
+        return None
+    profile = load_camera_profile(CAMERA_PROFILE_PATH)
+    node_cameras = discover_cameras(manifest_path)
+    logging.info("auditing Hanwha cameras...")
+    cameras = audit_hanwha_cameras(node_cameras, profile, max_workers=MAX_WORKERS)
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "profile": profile,
+        "cameras": cameras,
+        "drifted": len([c for c in cameras if len(c["drifted"]) > 0]),
+        "incomplete": len([c for c in cameras if len(c["unchecked"]) > 0]),
+        # cameras whose parameters could not be read
+        "failed": len([c for c in cameras if c["outcome"] == "error"]),
+    }
+
+
+def run(dry_run=False, plan_path=""):
+    """Plans and applies provisioning of cameras
+
+    Keyword Arguments:
+    --------
+    `dry_run` -- only computes the plan and writes it to plan_path or stdout
+
+    `plan_path` -- with dry_run, a path to save the plan to; otherwise, a path to the plan to apply
+    """
+    if plan_path != "" and not dry_run:
+        logging.info(f'loading plan from {plan_path}')
+        with open(plan_path, "r") as file:
+            plan = json.load(file)
+    else:
+        plan = make_plan(WAGGLE_MANIFEST_V2_PATH)
+        if plan == None:
+            return 1
+    if dry_run:
+        if plan_path != "":
+            logging.info(f'saving plan to {plan_path}')
+            with open(plan_path, "w") as file:
+                json.dump(plan, file, indent=4)
+        else:
+            print(json.dumps(plan, indent=4))
+        return 0
+    return apply_plan(plan)
+
 
 if __name__ == "__main__":
-    exit(run())
+    setup_logging(LOG_LEVEL, LOG_FORMAT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="compute the provisioning plan without changing cameras or datashim",
+    )
+    parser.add_argument(
+        "--plan",
+        default="",
+        help="path to save the plan to with --dry-run, or path of the plan to apply",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store_true",
+        help="print a report of cameras drifted from the desired state without changing them",
+    )
+    args = parser.parse_args()
+    if args.audit:
+        report = audit(WAGGLE_MANIFEST_V2_PATH)
+        if report == None:
+            exit(1)
+        print(json.dumps(report, indent=4))
+        exit(0 if report["drifted"] == 0 and report["failed"] == 0 else 1)
+    exit(run(dry_run=args.dry_run, plan_path=args.plan))
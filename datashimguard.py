@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import threading
+import time
+
+import kubernetes
+
+from camera_provisioner import (
+    DATASHIM_NAMESPACES,
+    LOG_FORMAT,
+    LOG_LEVEL,
+    get_datashim_entry_name,
+    get_kubernetes_api,
+)
+from eventlog import setup_logging, timed_event
+import utils
+
+# the server closes each watch after this many seconds; the watch resumes from the last resourceVersion
+WATCH_TIMEOUT_SECONDS = int(os.getenv("WATCH_TIMEOUT_SECONDS", "300"))
+# the camera registry is checked for changes every this many seconds
+REGISTRY_POLL_SECONDS = int(os.getenv("REGISTRY_POLL_SECONDS", "10"))
+
+
+class CameraRegistry(object):
+    """The camera registry kept in sync with its file; entries are a dict of namespace and camera entries
+
+    The provisioner rewrites the file before it applies datashim, so the registry is
+    reloaded whenever the modification time or the size of the file changes.
+    """
+
+    def __init__(self, registry_path):
+        self.registry_path = registry_path
+        self.stat = None
+        self.entries = {}
+
+    def reload(self) -> bool:
+        """Reloads the entries if the file changed; returns True if reloaded"""
+        try:
+            stat = os.stat(self.registry_path)
+            stat = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stat = None
+        if stat == self.stat:
+            return False
+        self.entries = utils.load_camera_registry(self.registry_path)
+        self.stat = stat
+        return True
+
+
+def find_diverged_cameras(datashim, registry:list) -> list:
+    """Returns names of cameras in the registry whose datashim entries are removed or changed"""
+    entries = {get_datashim_entry_name(e): e for e in datashim}
+    return [
+        get_datashim_entry_name(r) for r in registry
+        if entries.get(get_datashim_entry_name(r), None) != r
+    ]
+
+
+def restore_cameras(datashim, registry:list, camera_names:list) -> list:
+    """Returns a new datashim with entries of the cameras restored from the registry
+
+    Entries other than the cameras are kept as they are.
+    """
+    restored = {get_datashim_entry_name(r): r for r in registry if get_datashim_entry_name(r) in camera_names}
+    datashim = [e for e in datashim if get_datashim_entry_name(e) not in restored]
+    return datashim + list(restored.values())
+
+
+def guard_configmap(api, event:dict, registry:list, name="waggle-data-config"):
+    """Restores camera entries of the datashim in a watch event if they diverged from the registry
+
+    A deleted Configmap is not recreated because the guard knows only camera entries;
+    the provisioner creates it with all entries on its next run.
+
+    Keyword Arguments:
+    --------
+    `api` -- a kubernetes.client.CoreV1Api
+
+    `event` -- a watch event of the datashim Configmap
+
+    `registry` -- a list of datashim entries of cameras that are known to be good
+
+    Returns:
+    --------
+    `restored` -- a list of camera names restored
+    """
+    configmap = event["object"]
+    namespace = configmap.metadata.namespace
+    if event["type"] == "DELETED":
+        logging.error(f"datashim in {namespace} was deleted. not restoring it as only camera entries are known. run the provisioner to recreate it")
+        return []
+    datashim = json.loads((configmap.data or {}).get("data-config.json", "[]"))
+    diverged = find_diverged_cameras(datashim, registry)
+    if len(diverged) == 0:
+        return []
+    logging.warning(f"cameras {diverged} diverged in datashim of {namespace}. restoring...")
+    datashim = restore_cameras(datashim, registry, diverged)
+    with timed_event("guard", namespace=namespace, cameras=diverged):
+        # the patch fails with a conflict if the Configmap changed after the event;
+        # the change will come as the next event
+        patch = {
+            "metadata": {"resourceVersion": configmap.metadata.resource_version},
+            "data": {"data-config.json": json.dumps(datashim, indent=4)},
+        }
+        api.patch_namespaced_config_map(name, namespace, patch)
+    return diverged
+
+
+def watch_datashim(api, namespace, registry:CameraRegistry, name="waggle-data-config", resource_version=None, timeout_seconds=WATCH_TIMEOUT_SECONDS):
+    """Watches the datashim Configmap in the namespace until the server closes the watch
+
+    Without resource_version the watch starts with the current Configmap. Bookmarks keep
+    the resource_version recent so that the watch resumes without listing Configmaps.
+    The registry is reloaded on every event if its file changed.
+
+    Returns:
+    --------
+    `resource_version` -- the resource_version to resume the watch from; None if expired
+    """
+    w = kubernetes.watch.Watch()
+    try:
+        for event in w.stream(
+            api.list_namespaced_config_map,
+            namespace,
+            field_selector=f"metadata.name={name}",
+            allow_watch_bookmarks=True,
+            resource_version=resource_version,
+            timeout_seconds=timeout_seconds,
+        ):
+            if event["type"] == "BOOKMARK":
+                continue
+            try:
+                registry.reload()
+                guard_configmap(api, event, registry.entries.get(namespace, []), name)
+            except kubernetes.client.rest.ApiException as e:
+                logging.warning(f"failed to restore datashim in {namespace}: {e.status} {e.reason}")
+    except kubernetes.client.rest.ApiException as e:
+        if e.status == 410:
+            logging.info(f"watch of datashim in {namespace} expired. restarting")
+            return None
+        raise
+    return w.resource_version
+
+
+def recheck_datashims(api, namespaces:list, registry:dict, name="waggle-data-config") -> dict:
+    """Restores diverged camera entries in the current datashim of the namespaces
+
+    Keyword Arguments:
+    --------
+    `registry` -- a dict of namespace and a list of datashim entries of cameras returned from utils.load_camera_registry
+
+    Returns:
+    --------
+    `restored` -- a dict of namespace and a list of camera names restored
+    """
+    restored = {}
+    for namespace in namespaces:
+        try:
+            configmap = api.read_namespaced_config_map(name, namespace)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 404:
+                logging.warning(f"datashim in {namespace} does not exist. skipping.")
+                continue
+            raise
+        restored[namespace] = guard_configmap(
+            api, {"type": "MODIFIED", "object": configmap}, registry.get(namespace, []), name
+        )
+    return restored
+
+
+def guard_registry(api, namespaces:list, registry_path, name="waggle-data-config", poll_seconds=REGISTRY_POLL_SECONDS):
+    """Rechecks the datashim of the namespaces when the camera registry changes
+
+    A registry change does not come as a watch event. The recheck waits one more poll
+    so that the provisioner applies the datashim it saved the registry for first.
+    """
+    registry = CameraRegistry(registry_path)
+    registry.reload()
+    changed = False
+    while True:
+        time.sleep(poll_seconds)
+        if registry.reload():
+            changed = True
+            continue
+        if not changed:
+            continue
+        logging.info(f"camera registry {registry_path} changed. rechecking datashim")
+        try:
+            recheck_datashims(api, namespaces, registry.entries, name)
+            changed = False
+        except Exception as e:
+            logging.error(f"rechecking datashim failed: {str(e)}. retrying")
+
+
+def guard_namespace(api, namespace, registry_path, name="waggle-data-config"):
+    resource_version = None
+    registry = CameraRegistry(registry_path)
+    while True:
+        try:
+            resource_version = watch_datashim(api, namespace, registry, name, resource_version)
+        except Exception as e:
+            logging.error(f"watching datashim in {namespace} failed: {str(e)}. retrying in 10 seconds")
+            resource_version = None
+            time.sleep(10)
+
+
+def run():
+    """Guards the datashim in default and DATASHIM_NAMESPACES against changes on cameras
+
+    Each namespace is watched in its own thread and another thread rechecks all of them
+    when the camera registry changes.
+    """
+    registry_path = utils.get_camera_registry_path()
+    logging.info(f"guarding datashim using camera registry {registry_path}")
+    api = get_kubernetes_api()
+    namespaces = ["default"] + DATASHIM_NAMESPACES
+    threads = [
+        threading.Thread(target=guard_namespace, args=(api, n, registry_path), daemon=True)
+        for n in namespaces
+    ]
+    threads.append(threading.Thread(target=guard_registry, args=(api, namespaces, registry_path), daemon=True))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return 0
+
+
+if __name__ == "__main__":
+    setup_logging(LOG_LEVEL, LOG_FORMAT)
+    exit(run())
@@ -0,0 +1,163 @@
+import atexit
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from contextlib import contextmanager
+
+# the queue listener started by setup_logging
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a log record into a single JSON line
+
+    Fields of an event given by `log_event` are added to the line next to time, level
+    and message.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "event", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+    """Puts log records in a queue keeping the traceback apart from the message
+
+    logging.handlers.QueueHandler merges the traceback into the message. This keeps it
+    in exc_text so that JSONFormatter writes it as its own field.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(level="INFO", log_format="json", stream=None):
+    """Sets up the root logger to write logs through a queue
+
+    Log records are put in a queue by the calling thread and written by a background
+    thread so that logging does not block provisioning threads.
+
+    Keyword Arguments:
+    --------
+    `level` -- logging level of the root logger
+
+    `log_format` -- json for one JSON line per record; otherwise, plain text
+
+    `stream` -- (Optional) a stream to write logs to; stderr if not given
+
+    Returns:
+    --------
+    `listener` -- a started logging.handlers.QueueListener, stopped at exit or by `stop_logging`
+    """
+    global _listener
+    stop_logging()
+    handler = logging.StreamHandler(stream)
+    if log_format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(message)s", datefmt="%Y/%m/%d %H:%M:%S")
+        )
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.handlers = [EventQueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    _listener = listener
+    return listener
+
+
+def stop_logging():
+    """Stops the queue listener after writing all queued log records"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+def log_event(stage, outcome, level=logging.INFO, **fields):
+    """Logs an event of a stage with its outcome
+
+    Keyword Arguments:
+    --------
+    `stage` -- name of the stage, e.g., inspect, apply, datashim
+
+    `outcome` -- result of the stage, e.g., ok, error, configured
+
+    `fields` -- additional fields of the event, e.g., camera_ip, camera_mac, duration
+    """
+    logger = logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+    event = dict(stage=stage, outcome=outcome, **fields)
+    logger.log(level, f"{stage}: {outcome}", extra={"event": event})
+
+
+@contextmanager
+def timed_event(stage, **fields):
+    """Logs an event with the duration of the block
+
+    The outcome is ok unless the block sets "outcome" in the yielded dict or raises.
+    """
+    event = dict(fields, outcome="ok")
+    start = time.monotonic()
+    try:
+        yield event
+    except Exception:
+        event["outcome"] = "error"
+        raise
+    finally:
+        event["duration"] = round(time.monotonic() - start, 3)
+        log_event(stage, **event)
+
+
+def camera_stage(stage, outcome=lambda result: result["state"]):
+    """Decorates a function of a camera to log an event of the stage per camera
+
+    The decorated function takes a camera as the first argument and returns a dict with
+    ip and mac of the camera.
+
+    Keyword Arguments:
+    --------
+    `stage` -- name of the stage
+
+    `outcome` -- a function that returns the outcome from the result of the decorated function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(camera, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                result = func(camera, *args, **kwargs)
+            except Exception:
+                log_event(stage, "error", camera_ip=camera["ip"],
+                    duration=round(time.monotonic() - start, 3))
+                raise
+            log_event(stage, outcome(result), camera_ip=result["ip"],
+                camera_mac=result["mac"], duration=round(time.monotonic() - start, 3))
+            return result
+        return wrapper
+    return decorator
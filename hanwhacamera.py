@@ -1,12 +1,22 @@
+import calendar
 import json
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
 from hanwha_camera_client import HanwhaCameraClient
 
+from eventlog import camera_stage, log_event
+from imagequality import record_score, score_image
+
+# snapshots with Laplacian variance below the threshold are considered out of focus
+FOCUS_SHARPNESS_THRESHOLD = float(os.getenv("FOCUS_SHARPNESS_THRESHOLD", "100"))
+# the number of times Simple Focus runs again when the snapshot is out of focus
+FOCUS_RETRIES = max(int(os.getenv("FOCUS_RETRIES", "2")), 0)
+
 
 def get_camera_credential():
     return (
@@ -17,7 +27,7 @@ def get_camera_credential():
     )
 
 
-def configure_camera(ip_address, orientation, out_dir="/tmp"):
+def configure_camera(ip_address, orientation, out_dir=None):
     """Configure Hanwha camera
 
     Configures Hanwha camera in the following ways,
@@ -34,7 +44,7 @@ def configure_camera(ip_address, orientation, out_dir="/tmp"):
 
     - Back up the current configuration
 
-    - Take a snapshot
+    - Take a snapshot and check if the camera is in focus, running Simple Focus again if not
 
     Keyword Arguments:
     --------
@@ -46,12 +56,16 @@ def configure_camera(ip_address, orientation, out_dir="/tmp"):
 
     `waggle_user_password` -- The waggle user is set with this password
 
-    `out_dir` -- Directory path where camera configuration back up and a snapshot will be stored
+    `out_dir` -- Directory path where camera configuration back up and a snapshot will be stored; CAMERA_ARTIFACTS_DIR or /tmp if not given
 
     Returns:
     --------
     `success` -- boolean indicating whether the configuration succeeded
+
+    `focus` -- a dict returned from `check_focus`; None if focus could not be checked
     """
+    if out_dir is None:
+        out_dir = os.getenv("CAMERA_ARTIFACTS_DIR", "/tmp")
     admin, admin_password, user, user_password = get_camera_credential()
     with HanwhaCameraClient(
         host=f"http://{ip_address}", user=admin, password=admin_password
@@ -62,31 +76,31 @@ def configure_camera(ip_address, orientation, out_dir="/tmp"):
         )
         if ret == False:
             logging.error(f"{ip_address}: Failed to set device information")
-            return False
+            return False, None
 
         logging.info(f"{ip_address}: Updating system time")
         ret = client.update_system_time_using_host_time()
         if ret == False:
             logging.error(f"{ip_address}: Failed to set system time")
-            return False
+            return False, None
 
         logging.info(f"{ip_address}: Getting waggle user")
         ret, user_info = client.get_user("waggle")
         if ret == False:
             logging.error(f"{ip_address}: Failed to retreive waggle user information")
-            return False
+            return False, None
         if user_info == None:
             logging.info(f"{ip_address}: User waggle not exist. Creating.")
             ret = client.remove_user(user_index=1)
             if ret == False:
                 logging.error(f"{ip_address}: Failed to remove user 1")
-                return False
+                return False, None
             ret = client.add_user(
                 user_index=1, user_ID=user, plain_password=user_password, enable=True
             )
             if ret == False:
                 logging.error(f"{ip_address}: Failed to create waggle user")
-                return False
+                return False, None
         else:
             logging.info(f"{ip_address}: User waggle already exists. Skipping. ")
 
@@ -94,13 +108,13 @@ def configure_camera(ip_address, orientation, out_dir="/tmp"):
         ret = client.update_rtsp_authentication(protected=False)
         if ret == False:
             logging.error(f"{ip_address}: Failed to set RTSP subscription without authentication")
-            return False
+            return False, None
 
         logging.info(f"{ip_address}: Creating device info under {out_dir}")
         ret, device_info = client.get_device_information()
         if ret == False:
             logging.error(f"{ip_address}: Failed to get device information")
-            return False
+            return False, None
         with open(os.path.join(out_dir, f"device_info_{ip_address}.json"), "w") as file:
             json.dump(device_info, file, indent=4)
 
@@ -121,14 +135,79 @@ def configure_camera(ip_address, orientation, out_dir="/tmp"):
             )
             client.simple_focus()
             time.sleep(5)
+        focus = check_focus(client, ip_address, out_dir, retries=FOCUS_RETRIES if ret != False else 0)
+    return True, focus
+
+
+def check_focus(client, ip_address, out_dir="/tmp", retries=FOCUS_RETRIES):
+    """Takes a snapshot and checks if the camera is in focus
+
+    The snapshot is scored by its sharpness. While the score is below the threshold,
+    Simple Focus runs again up to `retries` times. Every score is appended to
+    focus_<ip_address>.jsonl under out_dir to keep the trend.
+
+    Keyword Arguments:
+    --------
+    `client` -- an opened HanwhaCameraClient
+
+    `ip_address` -- IP address of the camera
+
+    `out_dir` -- Directory path where the snapshot and scores will be stored
+
+    `retries` -- the number of times Simple Focus runs again when the snapshot is blurry
+
+    Returns:
+    --------
+    `score` -- a dict returned from imagequality.score_image with "focused" of the last scored snapshot; None if no snapshot could be scored
+    """
+    snapshot_path = os.path.join(out_dir, f"snapshot_{ip_address}.jpg")
+    score = None
+    for attempt in range(max(retries, 0) + 1):
+        if attempt > 0:
+            logging.warning(f"{ip_address}: Snapshot is blurry. Running Simple Focus again ({attempt}/{retries})")
+            client.simple_focus()
+            time.sleep(5)
         logging.info(f"{ip_address}: Taking a snapshot")
-        ret = client.take_snapshot(os.path.join(out_dir, f"snapshot_{ip_address}.jpg"))
+        ret = client.take_snapshot(snapshot_path)
         if ret == False:
             logging.error(f"{ip_address}: Failed to take a snapshot")
-    return True
+            break
+        try:
+            new_score = score_image(snapshot_path)
+        except Exception as e:
+            logging.error(f"{ip_address}: Failed to score the snapshot: {str(e)}")
+            break
+        score = new_score
+        score["focused"] = score["sharpness"] >= FOCUS_SHARPNESS_THRESHOLD
+        record_score(
+            os.path.join(out_dir, f"focus_{ip_address}.jsonl"), score, ip=ip_address, attempt=attempt
+        )
+        if score["focused"]:
+            break
+    if score is None:
+        return None
+    if not score["focused"]:
+        logging.error(f"{ip_address}: Camera is out of focus (sharpness {score['sharpness']} < {FOCUS_SHARPNESS_THRESHOLD})")
+    log_event(
+        "focus",
+        "focused" if score["focused"] else "blurry",
+        camera_ip=ip_address,
+        sharpness=score["sharpness"],
+        brightness=score["brightness"],
+        attempts=attempt + 1,
+    )
+    return score
 
 
 def initialize_camera(camera):
+    """Initializes Hanwha camera in factory default state and configures it
+
+    Returns:
+    --------
+    `success` -- boolean indicating whether the camera is initialized
+
+    `focus` -- a dict returned from `check_focus` if the camera is configured; otherwise None
+    """
     admin, admin_password, _, _ = get_camera_credential()
     with HanwhaCameraClient(
         host=f"http://{camera.ip}", user=admin, password=admin_password
@@ -136,64 +215,356 @@ def initialize_camera(camera):
         ret, initialized, _ = client.is_factory_admin_password_set()
         if ret == False:
             logging.error(f"{camera.ip}: Failed to query if the camera is in factory default state")
-            return False
+            return False, None
         if initialized:
             logging.info(f"{camera.ip}: Already initialized")
-            return True
+            return True, None
         logging.info(f"{camera.ip} is not initialized. Initializing...")
         ret = client.set_factory_admin_password(admin_password)
         if ret == False:
             logging.error(f"{camera.ip}: Failed to set admin password in factory default state")
-            return False
+            return False, None
     logging.info(f"Waiting for 5 seconds to see {camera.ip} come back")
     time.sleep(5)
     logging.info(f"{camera.ip} is being configured...")
     return configure_camera(ip_address=camera.ip, orientation=camera.orientation)
 
 
-def update_hanwha_camera(node_cameras):
-    """Update or provision Hanwha cameras
+def _get_field(camera, key):
+    value = camera.get(key, "")
+    if pd.isnull(value):
+        return ""
+    return value
+
+
+@camera_stage("inspect")
+def inspect_hanwha_camera(camera):
+    """Inspect Hanwha camera without changing anything on the camera
+
+    Only read-only calls are made to the camera. The returned plan lists the actions
+    needed to provision the camera, which are executed by `apply_hanwha_camera_plan`.
+
+    Actions:
+    --------
+    `initialize` -- the camera is in factory default state and needs to be initialized and configured
+
+    `sync_device_information` -- DeviceDescription of the camera does not match with its IP address
 
     Keyword Arguments:
     --------
-    `node_cameras` -- a list of camera objects in pandas.DataFrame currently recognized from node
+    `camera` -- a camera row in pandas.Series currently recognized from node
 
     Returns:
     --------
-    `node_cameras` -- an updated node_cameras
+    `camera_plan` -- a dict describing the camera, its state, and the actions to apply
     """
     admin, admin_password, _, _ = get_camera_credential()
-    for ip, camera in node_cameras.iterrows():
-        logging.info(f"attempting to get status of camera {camera.ip} ({camera.mac})")
-        if initialize_camera(camera) == False:
-            logging.error(f"{camera.ip}: Failed to initialize the camera. Maybe it is not a Hanwha camera. Skipping...")
-            continue
+    camera_plan = {
+        "ip": camera.ip,
+        "mac": _get_field(camera, "mac"),
+        "orientation": _get_field(camera, "orientation"),
+        "port": _get_field(camera, "port"),
+        "model": "",
+        "stream": "",
+        "state": "unknown",
+        "note": "",
+        "focus": None,
+        "actions": [],
+    }
+    with HanwhaCameraClient(
+        host=f"http://{camera.ip}", user=admin, password=admin_password
+    ) as client:
+        ret, initialized, _ = client.is_factory_admin_password_set()
+        if ret == False:
+            logging.error(f"{camera.ip}: Failed to query if the camera is in factory default state")
+            camera_plan["state"] = "error"
+            camera_plan["note"] = "failed to query factory default state. maybe it is not a Hanwha camera"
+            return camera_plan
+        if not initialized:
+            logging.info(f"{camera.ip}: In factory default state. It will be initialized")
+            camera_plan["state"] = "factory"
+            camera_plan["actions"].append("initialize")
+            return camera_plan
+        ret, device_info = client.get_device_information()
+        if ret == False:
+            logging.error(f"{camera.ip}: Failed to get device information")
+            camera_plan["state"] = "error"
+            camera_plan["note"] = "failed to get device information"
+            return camera_plan
+        camera_plan["orientation"] = device_info["DeviceLocation"]
+        camera_plan["model"] = device_info["Model"]
+        camera_plan["mac"] = device_info["ConnectedMACAddress"].lower()
+        if camera.ip != device_info["DeviceDescription"]:
+            logging.warning(f'{device_info["DeviceDescription"]} does not match with {camera.ip}. the information will be synced with the camera')
+            camera_plan["actions"].append("sync_device_information")
+        ret, stream = client.get_rtsp_stream_uri()
+        if ret == False:
+            logging.error(f"{camera.ip}: Failed to get RTSP stream URI")
+            camera_plan["state"] = "error"
+            camera_plan["note"] = "failed to get RTSP stream URI"
+            return camera_plan
+        camera_plan["stream"] = stream
+        camera_plan["state"] = "configured"
+    return camera_plan
+
+
+def plan_hanwha_cameras(node_cameras, max_workers=4):
+    """Inspect Hanwha cameras in parallel without changing them
+
+    Keyword Arguments:
+    --------
+    `node_cameras` -- a list of camera objects in pandas.DataFrame currently recognized from node
+
+    `max_workers` -- the number of cameras inspected at the same time
+
+    Returns:
+    --------
+    `camera_plans` -- a list of camera plans in the order of node_cameras
+    """
+    cameras = [camera for _, camera in node_cameras.iterrows()]
+    if len(cameras) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(inspect_hanwha_camera, cameras))
+
+
+@camera_stage("apply")
+def apply_hanwha_camera(camera_plan):
+    """Execute the actions of a camera plan made by `inspect_hanwha_camera`
+
+    Keyword Arguments:
+    --------
+    `camera_plan` -- a dict describing the camera and the actions to apply
+
+    Returns:
+    --------
+    `camera_plan` -- the camera plan updated with the state of the camera after applying the actions; an initialized camera gets "focus" with the result of `check_focus` and a note if it is out of focus
+    """
+    actions = camera_plan["actions"]
+    if "initialize" in actions:
+        camera = pd.Series(camera_plan)
+        ret, focus = initialize_camera(camera)
+        if ret == False:
+            logging.error(f"{camera.ip}: Failed to initialize the camera. Skipping...")
+            return dict(camera_plan, state="error", note="failed to initialize", actions=[])
+        # device information and stream can only be resolved after initialization
+        camera_plan = inspect_hanwha_camera(camera)
+        actions = camera_plan["actions"]
+        camera_plan["focus"] = focus
+        if focus is None:
+            camera_plan["note"] = "focus not checked"
+        elif not focus["focused"]:
+            camera_plan["note"] = f"out of focus (sharpness {focus['sharpness']} < {FOCUS_SHARPNESS_THRESHOLD})"
+    if "sync_device_information" in actions:
+        admin, admin_password, _, _ = get_camera_credential()
         with HanwhaCameraClient(
-            host=f"http://{camera.ip}", user=admin, password=admin_password
+            host=f"http://{camera_plan['ip']}", user=admin, password=admin_password
         ) as client:
-            ret, device_info = client.get_device_information()
+            ret = client.update_device_information(camera_plan["ip"], camera_plan["orientation"])
             if ret == False:
-                logging.error(f"{camera.ip}: Failed to get device information. Skipping...")
-                continue
-            logging.debug(json.dumps(device_info, indent=4))
-            camera_ip = device_info["DeviceDescription"]
-            camera_orientation = device_info["DeviceLocation"]
-            camera_model = device_info["Model"]
-            camera_mac = device_info["ConnectedMACAddress"].lower()
-            if camera.ip != camera_ip:
-                logging.warning(f"{camera_ip} does not match with {camera.ip}. sync the information with the camera")
-                ret = client.update_device_information(camera.ip, camera_orientation)
-                if ret == False:
-                    logging.warning(
-                        f"{camera_ip}: Failed to correct DeviceDescription with {camera.ip}."
-                    )
-            ret, stream = client.get_rtsp_stream_uri()
-            if ret == False:
-                logging.error(f"{camera.ip}: Failed to get RTSP stream URI. Skipping...")
-                continue
-            node_cameras.at[ip, "orientation"] = camera_orientation
-            node_cameras.at[ip, "model"] = camera_model
-            node_cameras.at[ip, "mac"] = camera_mac
-            node_cameras.at[ip, "stream"] = stream
-            node_cameras.at[ip, "state"] = "configured"
-    return node_cameras
+                logging.warning(
+                    f"{camera_plan['ip']}: Failed to correct DeviceDescription."
+                )
+    return dict(camera_plan, actions=[])
+
+
+def apply_hanwha_camera_plan(camera_plans, max_workers=4):
+    """Execute camera plans in parallel
+
+    Cameras without any action are returned as they are without contacting the camera.
+
+    Keyword Arguments:
+    --------
+    `camera_plans` -- a list of camera plans made by `plan_hanwha_cameras`
+
+    `max_workers` -- the number of cameras provisioned at the same time
+
+    Returns:
+    --------
+    `camera_plans` -- a list of camera plans updated with the state of cameras after applying
+    """
+    results = list(camera_plans)
+    pending = [i for i, c in enumerate(camera_plans) if len(c["actions"]) > 0]
+    if len(pending) == 0:
+        return results
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        applied = executor.map(apply_hanwha_camera, [camera_plans[i] for i in pending])
+        for i, camera_plan in zip(pending, applied):
+            results[i] = camera_plan
+    return results
+
+
+# Desired state of a provisioned Hanwha camera used by the drift audit
+# --------
+# firmware_versions: accepted firmware versions; empty accepts any version
+# users: users that must exist on the camera
+#
+# HanwhaCameraClient has no reader for the following groups yet. They are audited only
+# if a profile given in CAMERA_PROFILE_PATH sets them, and then reported as unchecked.
+# rtsp_protected: whether RTSP subscription requires authentication
+# iris_auto: whether auto iris/focus is enabled
+# max_time_offset_seconds: allowed difference between camera and host time
+DESIRED_CAMERA_PROFILE = {
+    "firmware_versions": [],
+    "users": ["waggle"],
+}
+
+
+def read_camera_parameters(client, profile=DESIRED_CAMERA_PROFILE) -> dict:
+    """Reads parameters of Hanwha camera needed for the drift audit
+
+    Each parameter group is read once over a single client session so that the audit
+    costs one CGI call per group. HanwhaCameraClient provides no reader for RTSP
+    authentication, iris mode and system time; those are not read.
+
+    Keyword Arguments:
+    --------
+    `client` -- an opened HanwhaCameraClient
+
+    `profile` -- the desired state profile to know which users to read
+
+    Returns:
+    --------
+    `parameters` -- a dict of device information, users and host time
+    """
+    ret, device_info = client.get_device_information()
+    if ret == False:
+        raise RuntimeError("failed to get device information")
+    users = {}
+    for user in profile["users"]:
+        ret, users[user] = client.get_user(user)
+        if ret == False:
+            raise RuntimeError(f"failed to get user {user}")
+    return {
+        "device_info": device_info,
+        "users": users,
+        "host_time": time.time(),
+    }
+
+
+def _parse_camera_time(system_time):
+    # SUNAPI reports UTC time as 2024-01-31T12:34:56Z
+    try:
+        return calendar.timegm(time.strptime(system_time["UTCTime"], "%Y-%m-%dT%H:%M:%SZ"))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def compare_camera_parameters(ip_address, parameters:dict, profile=DESIRED_CAMERA_PROFILE) -> dict:
+    """Compares camera parameters with the desired state profile
+
+    Only the parameter groups set in the profile are compared. A group the profile sets
+    but the parameters lack is reported as unchecked.
+
+    Keyword Arguments:
+    --------
+    `ip_address` -- IP address of the camera
+
+    `parameters` -- a dict returned from `read_camera_parameters`
+
+    `profile` -- the desired state profile
+
+    Returns:
+    --------
+    `drift` -- a dict with a list of drifted parameters and a list of parameters that could not be checked
+    """
+    drifted = []
+    unchecked = []
+
+    def check(parameter, expected, actual, ok):
+        if actual is None:
+            unchecked.append(parameter)
+        elif not ok:
+            drifted.append({"parameter": parameter, "expected": expected, "actual": actual})
+
+    device_info = parameters["device_info"] or {}
+    accepted = profile["firmware_versions"]
+    if len(accepted) > 0:
+        firmware = device_info.get("FirmwareVersion", None)
+        check("firmware", accepted, firmware, firmware in accepted)
+    description = device_info.get("DeviceDescription", None)
+    check("device_description", ip_address, description, description == ip_address)
+    location = device_info.get("DeviceLocation", None)
+    check("device_location", "non-empty", location, location != "")
+    for user in profile["users"]:
+        if user not in parameters["users"]:
+            unchecked.append(f"user_{user}")
+            continue
+        user_info = parameters["users"][user]
+        check(f"user_{user}", "exists", "missing" if user_info is None else "exists", user_info is not None)
+    for parameter in ["rtsp_protected", "iris_auto"]:
+        if parameter in profile:
+            actual = parameters.get(parameter, None)
+            check(parameter, profile[parameter], actual, actual == profile[parameter])
+    if "max_time_offset_seconds" in profile:
+        camera_time = _parse_camera_time(parameters.get("system_time", None))
+        offset = None if camera_time is None else round(abs(camera_time - parameters["host_time"]))
+        max_offset = profile["max_time_offset_seconds"]
+        check("time_offset_seconds", f"<= {max_offset}", offset, offset is not None and offset <= max_offset)
+    return {"drifted": drifted, "unchecked": unchecked}
+
+
+def _audit_outcome(report):
+    if report["error"] != "":
+        return "error"
+    if len(report["drifted"]) > 0:
+        return "drifted"
+    if len(report["unchecked"]) > 0:
+        return "incomplete"
+    return "ok"
+
+
+@camera_stage("audit", outcome=lambda report: report["outcome"])
+def audit_hanwha_camera(camera, profile=DESIRED_CAMERA_PROFILE) -> dict:
+    """Audits Hanwha camera against the desired state profile without changing the camera
+
+    Keyword Arguments:
+    --------
+    `camera` -- a camera row in pandas.Series currently recognized from node
+
+    `profile` -- the desired state profile
+
+    Returns:
+    --------
+    `report` -- a dict with the camera, its drifted and unchecked parameters, an error if the audit failed, and the outcome; one of ok, drifted, incomplete and error
+    """
+    admin, admin_password, _, _ = get_camera_credential()
+    report = {"ip": camera.ip, "mac": _get_field(camera, "mac"), "drifted": [], "unchecked": [], "error": ""}
+    with HanwhaCameraClient(
+        host=f"http://{camera.ip}", user=admin, password=admin_password
+    ) as client:
+        try:
+            parameters = read_camera_parameters(client, profile)
+        except Exception as e:
+            logging.error(f"{camera.ip}: Failed to read camera parameters: {str(e)}")
+            report["error"] = str(e)
+    if report["error"] == "":
+        report.update(compare_camera_parameters(camera.ip, parameters, profile))
+    if len(report["drifted"]) > 0:
+        logging.warning(f"{camera.ip}: {len(report['drifted'])} parameters drifted from the desired state")
+    if len(report["unchecked"]) > 0:
+        logging.warning(f"{camera.ip}: {report['unchecked']} could not be checked")
+    report["outcome"] = _audit_outcome(report)
+    return report
+
+
+def audit_hanwha_cameras(node_cameras, profile=DESIRED_CAMERA_PROFILE, max_workers=4):
+    """Audits Hanwha cameras in parallel
+
+    Keyword Arguments:
+    --------
+    `node_cameras` -- a list of camera objects in pandas.DataFrame currently recognized from node
+
+    `profile` -- the desired state profile
+
+    `max_workers` -- the number of cameras audited at the same time
+
+    Returns:
+    --------
+    `reports` -- a list of drift reports in the order of node_cameras
+    """
+    cameras = [camera for _, camera in node_cameras.iterrows()]
+    if len(cameras) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda c: audit_hanwha_camera(c, profile), cameras))
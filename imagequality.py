@@ -0,0 +1,73 @@
+import json
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def load_grayscale(image_path, max_size=640):
+    """Loads an image as a downscaled grayscale array
+
+    JPEG images are decoded at a reduced scale so that a full resolution frame is never
+    held in memory.
+
+    Keyword Arguments:
+    --------
+    `image_path` -- a path to the image
+
+    `max_size` -- the maximum width and height of the loaded image
+
+    Returns:
+    --------
+    `gray` -- a 2D numpy.ndarray of float32 in 0-255
+    """
+    with Image.open(image_path) as image:
+        image.draft("L", (max_size, max_size))
+        image = image.convert("L")
+        image.thumbnail((max_size, max_size))
+        return np.asarray(image, dtype=np.float32)
+
+
+def laplacian_variance(gray) -> float:
+    """Returns variance of the Laplacian of the image; the higher, the sharper"""
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+
+def exposure_histogram(gray, bins=16) -> list:
+    """Returns the fraction of pixels in each of equally sized intensity bins"""
+    histogram, _ = np.histogram(gray, bins=bins, range=(0, 256))
+    return (histogram / max(gray.size, 1)).round(4).tolist()
+
+
+def score_image(image_path, max_size=640) -> dict:
+    """Scores focus and exposure of an image
+
+    Keyword Arguments:
+    --------
+    `image_path` -- a path to the image
+
+    `max_size` -- the maximum width and height the image is downscaled to before scoring
+
+    Returns:
+    --------
+    `score` -- a dict with sharpness, mean brightness, fractions of under and over exposed pixels, and the histogram
+    """
+    gray = load_grayscale(image_path, max_size)
+    return {
+        "sharpness": round(laplacian_variance(gray), 2),
+        "brightness": round(float(gray.mean()), 2),
+        "underexposed": round(float((gray < 16).mean()), 4),
+        "overexposed": round(float((gray >= 240).mean()), 4),
+        "histogram": exposure_histogram(gray),
+    }
+
+
+def record_score(score_path, score:dict, **fields):
+    """Appends the score as a JSON line with the time to keep the trend of scores"""
+    entry = dict(fields, time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), **score)
+    with open(score_path, "a") as file:
+        file.write(json.dumps(entry) + "\n")
@@ -1,3 +1,4 @@
+import ipaddress
 import logging
 import os
 import re
@@ -38,6 +39,32 @@ def get_networkswitch_credential():
     )
 
 
+def get_camera_ip_range():
+    """Returns the nmap target of cameras of the node, e.g., 10.31.81.10-20 or 10.31.81.8/29"""
+    return os.getenv("WAGGLE_CAMERA_IP_RANGE", "10.31.81.10-20")
+
+
+def expand_ip_range(ip_range) -> set:
+    """Returns the set of IPv4 addresses in the range
+
+    Only a single address, a range of the last octet (10.31.81.10-20) and a CIDR block
+    (10.31.81.8/29) are accepted; ValueError is raised for other nmap targets.
+    """
+    try:
+        if "/" in ip_range:
+            return set(ipaddress.IPv4Network(ip_range, strict=False))
+        if "-" in ip_range:
+            start, end = ip_range.split("-")
+            start = ipaddress.IPv4Address(start)
+            end = ipaddress.IPv4Address(str(start).rsplit(".", 1)[0] + "." + end)
+            if end < start:
+                raise ValueError
+            return {ipaddress.IPv4Address(i) for i in range(int(start), int(end) + 1)}
+        return {ipaddress.IPv4Address(ip_range)}
+    except ValueError:
+        raise ValueError(f"unsupported camera IP range {ip_range}")
+
+
 def get_cameras_from_switch(skip_pinging=False):
     """Returns updated list of cameras from Unifi edgeswitch 8
 
@@ -99,14 +126,13 @@ def get_ports_from_switch(cameras):
 
 
 def get_cameras_from_nmap():
-    """Returns a list of cameras from nmap over 10.31.81.10-20
+    """Returns a list of cameras from nmap over the range from `get_camera_ip_range`
 
     Execution of nmap returns MAC address of recognized devices when the network privilege
     is granted. Please make sure the privilege is given when calling.
 
-    WARNING: This function does not work if the IP range isn't properly set.
-    For example, it will catch 10.31.81.114 as camera because of the regex rule
-    in the function
+    Hosts without MAC address, such as the scanning host itself, and the network switch
+    are not considered as cameras.
 
     Expected output would be,
     ```
@@ -128,22 +154,26 @@ def get_cameras_from_nmap():
     `cameras` -- a pandas.Dataframe with cameras recognized from nmap
     """
     cameras = create_dataframe()
-    output = subprocess.check_output(("nmap", "-sP", "10.31.81.10-20"))
+    output = subprocess.check_output(("nmap", "-sP", get_camera_ip_range()))
     output_newlined = output.decode().strip().split("\n")
-    found_ip = None
+    hosts = []
     for line in output_newlined:
-        found = re.search("10.31.81.[0-9]{2}", line)
+        found = re.search("^Nmap scan report for .*?([0-9]{1,3}(?:\\.[0-9]{1,3}){3})", line)
         if found:
-            if found_ip is not None:
-                data = {"ip": found_ip["ip"], "mac": found_ip["mac"].lower()}
-                cameras = pd.concat([cameras, create_row(data, name=found_ip["ip"]).to_frame().T])
-            found_ip = {"ip": found.string[found.start() : found.end()]}
+            hosts.append({"ip": found.group(1)})
             continue
-        found = re.search("(?:[0-9a-zA-Z]:?){12}", line)
-        if found:
-            if found_ip is not None:
-                found_ip.update({"mac": found.string[found.start() : found.end()]})
-    if found_ip is not None:
-        data = {"ip": found_ip["ip"], "mac": found_ip["mac"].lower()}
-        cameras = pd.concat([cameras, create_row(data, name=found_ip["ip"]).to_frame().T])
+        found = re.search("^MAC Address: ((?:[0-9a-zA-Z]:?){12})", line)
+        if found and len(hosts) > 0:
+            hosts[-1]["mac"] = found.group(1)
+    switch_address, _, _ = get_networkswitch_credential()
+    for host in hosts:
+        # nmap reports the scanning host itself without MAC address
+        if "mac" not in host:
+            logging.info(f'skipping {host["ip"]} as it has no MAC address')
+            continue
+        if host["ip"] == switch_address:
+            logging.info(f'skipping {host["ip"]} as it is the network switch')
+            continue
+        data = {"ip": host["ip"], "mac": host["mac"].lower()}
+        cameras = pd.concat([cameras, create_row(data, name=host["ip"]).to_frame().T])
     return cameras
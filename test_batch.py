@@ -0,0 +1,167 @@
+import unittest
+import json
+import os
+import tempfile
+from unittest import mock
+import camera_provisioner
+import hanwhacamera
+import networkswitch
+from batch import check_nodes, find_node_manifests, run_batch, run_node, summarize
+from test_camera_provisioner import CREDENTIALS, FakeHanwhaCameraClient, create_fake_camera
+
+NMAP_OUTPUT = """Starting Nmap 7.80 ( https://nmap.org ) at 2022-01-24 17:36 UTC
+Nmap scan report for ws-nxcore (10.31.82.1)
+Host is up.
+Nmap scan report for 10.31.82.2
+Host is up (0.0011s latency).
+MAC Address: 74:83:C2:11:22:33 (Ubiquiti Networks)
+Nmap scan report for XNV-8081Z-E43022248D35 (10.31.82.10)
+Host is up (0.0011s latency).
+MAC Address: E4:30:22:24:8D:35 (Hanwha Techwin Security Vietnam)
+Nmap scan report for XNV-8081Z-E430222653AB (10.31.82.16)
+Host is up (0.0011s latency).
+MAC Address: E4:30:22:26:53:AB (Hanwha Techwin Security Vietnam)
+Nmap done: 11 IP addresses (2 hosts up) scanned in 0.50 seconds
+"""
+
+MANIFEST = {
+    "vsn": "W023",
+    "sensors": [
+        {"name": "top_camera", "hardware": {"hw_model": "XNV-8082R", "manufacturer": "hanwha"}},
+    ],
+    "resources": [],
+}
+
+class TestBatch(unittest.TestCase):
+    def test_find_node_manifests(self):
+        with tempfile.TemporaryDirectory() as batch_dir:
+            for name in ["W023", "W024", "W024.credentials.json", ".hidden"]:
+                open(os.path.join(batch_dir, name), "w").close()
+            nodes = find_node_manifests(batch_dir)
+        self.assertEqual([n["node"] for n in nodes], ["W023", "W024"])
+        self.assertEqual(nodes[0]["credentials"], "")
+        self.assertTrue(nodes[1]["credentials"].endswith("W024.credentials.json"))
+
+    def test_summarize(self):
+        results = [
+            {"node": "W023", "exit_code": 0, "cameras": 3, "configured": 3, "failed_cameras": [], "blurry_cameras": ["10.31.81.10"]},
+            {"node": "W024", "exit_code": 1, "cameras": 2, "configured": 1, "failed_cameras": ["10.31.81.12"], "blurry_cameras": []},
+        ]
+        report = summarize(results, 1800, 2)
+        self.assertEqual(report["failed_nodes"], ["W024"])
+        self.assertEqual(report["cameras"], 5)
+        self.assertEqual(report["cameras_per_hour"], 8.0)
+        self.assertEqual(report["failed_cameras"], {"W024": ["10.31.81.12"]})
+        self.assertEqual(report["blurry_cameras"], {"W023": ["10.31.81.10"]})
+
+    def create_nodes(self, batch_dir, credentials:dict):
+        for name, env in credentials.items():
+            open(os.path.join(batch_dir, name), "w").close()
+            with open(os.path.join(batch_dir, name + ".credentials.json"), "w") as file:
+                json.dump(env, file)
+        return find_node_manifests(batch_dir)
+
+    def test_check_nodes(self):
+        with tempfile.TemporaryDirectory() as batch_dir:
+            nodes = self.create_nodes(batch_dir, {
+                "W023": {"WAGGLE_CAMERA_IP_RANGE": "10.31.82.10-20", "KUBECONFIG": "/kube/W023"},
+                "W024": {"WAGGLE_CAMERA_IP_RANGE": "10.31.83.8/29", "KUBECONFIG": "/kube/W024"},
+            })
+            self.assertEqual(check_nodes(nodes), [])
+
+    def test_refuse_nodes_scanning_overlapping_ip_ranges(self):
+        with tempfile.TemporaryDirectory() as batch_dir:
+            nodes = self.create_nodes(batch_dir, {
+                "W023": {"KUBECONFIG": "/kube/W023"},
+                "W024": {"WAGGLE_CAMERA_IP_RANGE": "10.31.81.0/24", "KUBECONFIG": "/kube/W024"},
+                "W025": {"WAGGLE_CAMERA_IP_RANGE": "10.31.81.0-255,10.31.82.0", "KUBECONFIG": "/kube/W025"},
+            })
+            errors = check_nodes(nodes)
+            self.assertEqual(len(errors), 2)
+            self.assertIn("overlaps 10.31.81.10-20 of W023", errors[0])
+            self.assertIn("unsupported camera IP range", errors[1])
+            self.assertEqual(run_batch(batch_dir, batch_dir), None)
+            self.assertFalse(os.path.exists(os.path.join(batch_dir, "batch_report.json")))
+
+    def test_refuse_nodes_without_own_kubeconfig(self):
+        with tempfile.TemporaryDirectory() as batch_dir:
+            nodes = self.create_nodes(batch_dir, {
+                "W023": {"WAGGLE_CAMERA_IP_RANGE": "10.31.82.10-20"},
+                "W024": {"WAGGLE_CAMERA_IP_RANGE": "10.31.83.10-20", "KUBECONFIG": "/kube/config"},
+                "W025": {"WAGGLE_CAMERA_IP_RANGE": "10.31.84.10-20", "KUBECONFIG": "/kube/config"},
+            })
+            errors = check_nodes(nodes)
+            self.assertEqual(errors, [
+                "W023: no KUBECONFIG in the credentials",
+                "W025: KUBECONFIG /kube/config is also used by W024",
+            ])
+
+
+class TestRunningNode(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        manifest_path = os.path.join(self.dir.name, "W023")
+        with open(manifest_path, "w") as file:
+            json.dump(MANIFEST, file)
+        with open(manifest_path + ".credentials.json", "w") as file:
+            json.dump(dict(
+                CREDENTIALS,
+                WAGGLE_SWITCH_USER="admin",
+                WAGGLE_SWITCH_PASSWORD="password",
+                WAGGLE_SWITCH_ADDRESS="10.31.82.2",
+                WAGGLE_CAMERA_IP_RANGE="10.31.82.0/24",
+                KUBECONFIG=os.path.join(self.dir.name, "W023.kubeconfig"),
+            ), file)
+        self.node = find_node_manifests(self.dir.name)[0]
+        FakeHanwhaCameraClient.cameras = {
+            "10.31.82.10": create_fake_camera("10.31.82.10", "top"),
+            "10.31.82.16": create_fake_camera("10.31.82.16", "left", description="10.31.81.16"),
+        }
+        FakeHanwhaCameraClient.calls = []
+        self.nmap = mock.Mock(return_value=NMAP_OUTPUT.encode())
+        self.api = mock.Mock()
+        self.api.list_namespace.return_value.items = []
+        self.api.list_namespaced_config_map.return_value.items = []
+        for p in [
+            mock.patch("batch.setup_logging"),
+            mock.patch("batch.stop_logging"),
+            mock.patch.object(networkswitch.subprocess, "check_output", self.nmap),
+            mock.patch.object(camera_provisioner.time, "sleep"),
+            mock.patch.object(hanwhacamera, "HanwhaCameraClient", FakeHanwhaCameraClient),
+            mock.patch("camera_provisioner.get_kubernetes_api", return_value=self.api),
+        ]:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_run_node(self):
+        out_dir = os.path.join(self.dir.name, "out", "W023")
+        result = run_node(self.node, out_dir)
+        self.assertEqual(result["exit_code"], 0, result["error"])
+        self.nmap.assert_called_once_with(("nmap", "-sP", "10.31.82.0/24"))
+        self.assertEqual(result["cameras"], 2)
+        # 10.31.82.10 needed no action
+        self.assertEqual(result["configured"], 1)
+        self.assertEqual(FakeHanwhaCameraClient.calls, [("update_device_information", "10.31.82.16", "10.31.82.16")])
+        self.assertTrue(os.path.exists(os.path.join(out_dir, "plan.json")))
+        self.assertTrue(os.path.exists(os.path.join(out_dir, "applied_plan.json")))
+        self.assertTrue(os.path.exists(os.path.join(out_dir, "camera_registry.json")))
+        self.assertNotIn("WAGGLE_CAMERA_IP_RANGE", os.environ)
+        datashim = json.loads(self.api.create_namespaced_config_map.call_args.args[1].data["data-config.json"])
+        self.assertEqual(datashim[0]["handler"]["args"]["url"], "rtsp://10.31.82.10/profile2/media.smp")
+
+
+    def test_count_cameras_if_applying_datashim_fails(self):
+        out_dir = os.path.join(self.dir.name, "out", "W023")
+        with mock.patch("camera_provisioner.apply_datashim", side_effect=RuntimeError("unreachable")):
+            result = run_node(self.node, out_dir)
+        self.assertEqual(result["exit_code"], 1)
+        self.assertEqual(result["error"], "unreachable")
+        self.assertEqual((result["cameras"], result["configured"]), (2, 1))
+        with open(os.path.join(out_dir, "applied_plan.json")) as file:
+            plan = json.load(file)
+        self.assertEqual([c["actions"] for c in plan["cameras"]], [[], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,85 @@
 import unittest
 import json
-from camera_provisioner import get_cameras_from_manifest
+import os
+import tempfile
+from unittest import mock
+import kubernetes
+import numpy as np
+from PIL import Image
+from camera_provisioner import apply_plan, audit, get_cameras_from_manifest, plan_datashim, has_datashim_changes, quiet_kubernetes_logging
+import logging
 import utils
+import hanwhacamera
+from hanwhacamera import DESIRED_CAMERA_PROFILE, apply_hanwha_camera_plan, audit_hanwha_camera, check_focus, compare_camera_parameters
+
+CREDENTIALS = {
+    "WAGGLE_CAMERA_ADMIN": "admin",
+    "WAGGLE_CAMERA_ADMIN_PASSWORD": "password",
+    "WAGGLE_CAMERA_USER": "waggle",
+    "WAGGLE_CAMERA_USER_PASSWORD": "password",
+}
+
+class FakeHanwhaCameraClient(object):
+    """Stands in for hanwha_camera_client.HanwhaCameraClient with cameras kept in `cameras`"""
+    cameras = {}
+    calls = []
+
+    def __init__(self, host, user, password):
+        self.ip = host.replace("http://", "")
+        self.camera = self.cameras[self.ip]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def is_factory_admin_password_set(self):
+        return True, self.camera["initialized"], None
+
+    def get_device_information(self):
+        return True, self.camera["device_info"]
+
+    def get_rtsp_stream_uri(self):
+        return True, f"rtsp://{self.ip}/profile2/media.smp"
+
+    def get_user(self, user_id):
+        if self.camera.get("user_error", False):
+            return False, None
+        return True, self.camera.get("users", {}).get(user_id, None)
+
+    def take_snapshot(self, path):
+        snapshots = self.camera["snapshots"]
+        image = snapshots.pop(0) if len(snapshots) > 1 else snapshots[0]
+        if image is None:
+            return False
+        image.save(path, "JPEG")
+        return True
+
+    def simple_focus(self):
+        self.calls.append(("simple_focus", self.ip))
+        return True
+
+    def update_device_information(self, description, location):
+        self.calls.append(("update_device_information", self.ip, description))
+        self.camera["device_info"]["DeviceDescription"] = description
+        return True
+
+def create_fake_camera(ip, orientation, initialized=True, description=None):
+    return {
+        "initialized": initialized,
+        "device_info": {
+            "DeviceDescription": ip if description is None else description,
+            "DeviceLocation": orientation,
+            "Model": "XNV-8082R",
+            "ConnectedMACAddress": "E4:30:22:24:8D:35",
+        },
+        "users": {"waggle": {"UserID": "waggle"}},
+    }
+
+def create_camera_plan(ip, orientation, state, actions):
+    return {"ip": ip, "mac": "", "orientation": orientation, "port": "", "model": "",
+        "stream": "", "state": state, "note": "", "focus": None, "actions": actions}
 
 class TestFindingCameraFromManifest(unittest.TestCase):
     test_manifest = """
@@ -32,5 +110,241 @@ class TestFindingCameraFromManifest(unittest.TestCase):
     def test_skip_networkswitch_if_not_exist(self):
         self.assertTrue(utils.does_networkswitch_exist("V002"))
 
+class TestPlanningDatashim(unittest.TestCase):
+    def create_camera(self, name, state, url=""):
+        c = utils.CameraObject(name, "hanwha", "XNV-8082R")
+        c.set_state(state)
+        c.url = url
+        return c
+
+    def test_plan_datashim(self):
+        current = [
+            {"handler": {"args": {"url": "rtsp://old"}, "type": "video"}, "match": {"id": "top"}, "name": "top"},
+            {"handler": {"args": {"url": "rtsp://left"}, "type": "video"}, "match": {"id": "left"}, "name": "left"},
+        ]
+        manifest_cameras = [
+            self.create_camera("top", "registered", "rtsp://new"),
+            self.create_camera("bottom", "registered", "rtsp://bottom"),
+            self.create_camera("left", "unknown"),
+        ]
+        datashim_plan = plan_datashim({"default": current, "ses": None}, manifest_cameras)
+        changes = datashim_plan["namespaces"]["default"]
+        self.assertEqual(changes["added"], ["bottom"])
+        self.assertEqual(changes["updated"], ["top"])
+        self.assertEqual(changes["removed"], ["left"])
+        self.assertFalse(datashim_plan["namespaces"]["ses"]["exists"])
+        self.assertEqual(current[0]["handler"]["args"]["url"], "rtsp://old")
+
+    def test_plan_datashim_without_changes(self):
+        manifest_cameras = [self.create_camera("top", "registered", "rtsp://top")]
+        datashim_plan = plan_datashim({"default": []}, manifest_cameras)
+        datashim_plan = plan_datashim({"default": datashim_plan["data"]}, manifest_cameras)
+        self.assertFalse(has_datashim_changes(datashim_plan["namespaces"]["default"]))
+
+class TestQuietKubernetesLogging(unittest.TestCase):
+    def test_keep_root_level(self):
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(logging.WARNING)
+        with quiet_kubernetes_logging():
+            self.assertEqual(root.level, logging.WARNING)
+            self.assertFalse(logging.getLogger("kubernetes.client.rest").isEnabledFor(logging.INFO))
+        root.setLevel(logging.DEBUG)
+        with quiet_kubernetes_logging():
+            self.assertFalse(logging.getLogger("urllib3").isEnabledFor(logging.DEBUG))
+        self.assertTrue(logging.getLogger("urllib3").isEnabledFor(logging.DEBUG))
+
+class TestAuditingCamera(unittest.TestCase):
+    profile = dict(DESIRED_CAMERA_PROFILE, rtsp_protected=False, iris_auto=False, max_time_offset_seconds=60)
+
+    def create_parameters(self):
+        return {
+            "device_info": {"DeviceDescription": "10.31.81.10", "DeviceLocation": "top", "FirmwareVersion": "1.41.01"},
+            "users": {"waggle": {"UserID": "waggle"}},
+            "rtsp_protected": False,
+            "iris_auto": False,
+            "system_time": {"UTCTime": "2024-01-31T12:34:56Z"},
+            "host_time": 1706704500,
+        }
+
+    def test_no_drift(self):
+        drift = compare_camera_parameters("10.31.81.10", self.create_parameters(), self.profile)
+        self.assertEqual(drift["drifted"], [])
+        self.assertEqual(drift["unchecked"], [])
+
+    def test_drift(self):
+        parameters = self.create_parameters()
+        parameters["users"]["waggle"] = None
+        parameters["rtsp_protected"] = True
+        parameters["host_time"] += 3600
+        drift = compare_camera_parameters("10.31.81.11", parameters, self.profile)
+        drifted = [d["parameter"] for d in drift["drifted"]]
+        self.assertEqual(drifted, ["device_description", "user_waggle", "rtsp_protected", "time_offset_seconds"])
+
+    def test_unchecked_parameters(self):
+        parameters = self.create_parameters()
+        parameters["iris_auto"] = None
+        profile = dict(self.profile, firmware_versions=["1.00.00"])
+        drift = compare_camera_parameters("10.31.81.10", parameters, profile)
+        self.assertEqual([d["parameter"] for d in drift["drifted"]], ["firmware"])
+        self.assertEqual(drift["unchecked"], ["iris_auto"])
+
+class TestAuditingCameraWithClient(unittest.TestCase):
+    def setUp(self):
+        FakeHanwhaCameraClient.cameras = {"10.31.81.10": create_fake_camera("10.31.81.10", "top")}
+        for p in [
+            mock.patch.object(hanwhacamera, "HanwhaCameraClient", FakeHanwhaCameraClient),
+            mock.patch.dict(os.environ, CREDENTIALS),
+        ]:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_audit_ok(self):
+        report = audit_hanwha_camera(utils.create_row({"ip": "10.31.81.10", "mac": ""}))
+        self.assertEqual(report["drifted"], [])
+        self.assertEqual(report["unchecked"], [])
+        self.assertEqual(report["outcome"], "ok")
+
+    def test_audit_reports_unreadable_groups(self):
+        profile = dict(DESIRED_CAMERA_PROFILE, rtsp_protected=False, iris_auto=False, max_time_offset_seconds=60)
+        report = audit_hanwha_camera(utils.create_row({"ip": "10.31.81.10", "mac": ""}), profile)
+        self.assertEqual(report["drifted"], [])
+        self.assertEqual(report["unchecked"], ["rtsp_protected", "iris_auto", "time_offset_seconds"])
+        self.assertEqual(report["outcome"], "incomplete")
+
+    def test_audit_not_failing_incomplete_cameras(self):
+        profile = dict(DESIRED_CAMERA_PROFILE, rtsp_protected=False)
+        node_cameras = utils.create_dataframe([{"ip": "10.31.81.10", "mac": ""}])
+        with tempfile.NamedTemporaryFile() as manifest, \
+                mock.patch("camera_provisioner.load_camera_profile", return_value=profile), \
+                mock.patch("camera_provisioner.discover_cameras", return_value=node_cameras):
+            report = audit(manifest.name)
+        self.assertEqual((report["drifted"], report["incomplete"], report["failed"]), (0, 1, 0))
+
+    def test_audit_drifted(self):
+        FakeHanwhaCameraClient.cameras["10.31.81.10"]["users"] = {}
+        report = audit_hanwha_camera(utils.create_row({"ip": "10.31.81.10", "mac": ""}))
+        self.assertEqual([d["parameter"] for d in report["drifted"]], ["user_waggle"])
+        self.assertEqual(report["outcome"], "drifted")
+
+    def test_audit_error(self):
+        FakeHanwhaCameraClient.cameras["10.31.81.10"]["user_error"] = True
+        report = audit_hanwha_camera(utils.create_row({"ip": "10.31.81.10", "mac": ""}))
+        self.assertEqual(report["error"], "failed to get user waggle")
+        self.assertEqual(report["outcome"], "error")
+
+class TestCheckingFocus(unittest.TestCase):
+    blurry = Image.new("RGB", (1920, 1080), (90, 90, 90))
+    sharp = Image.fromarray(((np.indices((1080, 1920)) // 40).sum(axis=0) % 2 * 255).astype(np.uint8))
+
+    def setUp(self):
+        FakeHanwhaCameraClient.cameras = {"10.31.81.10": create_fake_camera("10.31.81.10", "top")}
+        FakeHanwhaCameraClient.calls = []
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        p = mock.patch.object(hanwhacamera.time, "sleep")
+        p.start()
+        self.addCleanup(p.stop)
+
+    def check_focus(self, snapshots, retries):
+        FakeHanwhaCameraClient.cameras["10.31.81.10"]["snapshots"] = snapshots
+        client = FakeHanwhaCameraClient("http://10.31.81.10", "admin", "password")
+        return check_focus(client, "10.31.81.10", self.dir.name, retries=retries)
+
+    def read_scores(self):
+        with open(os.path.join(self.dir.name, "focus_10.31.81.10.jsonl")) as file:
+            return [json.loads(line) for line in file]
+
+    def test_retry_until_focused(self):
+        score = self.check_focus([self.blurry, self.sharp], retries=2)
+        self.assertTrue(score["focused"])
+        self.assertEqual(FakeHanwhaCameraClient.calls, [("simple_focus", "10.31.81.10")])
+        self.assertEqual([(s["attempt"], s["focused"]) for s in self.read_scores()], [(0, False), (1, True)])
+
+    def test_blurry_after_retries(self):
+        score = self.check_focus([self.blurry], retries=2)
+        self.assertFalse(score["focused"])
+        self.assertLess(score["sharpness"], hanwhacamera.FOCUS_SHARPNESS_THRESHOLD)
+        self.assertEqual(len(FakeHanwhaCameraClient.calls), 2)
+        self.assertEqual(len(self.read_scores()), 3)
+
+    def test_keep_blurry_score_if_retry_fails(self):
+        score = self.check_focus([self.blurry, None], retries=2)
+        self.assertFalse(score["focused"])
+        self.assertEqual(len(self.read_scores()), 1)
+
+    def test_negative_retries(self):
+        score = self.check_focus([self.blurry], retries=-1)
+        self.assertFalse(score["focused"])
+        self.assertEqual(FakeHanwhaCameraClient.calls, [])
+
+
+class TestApplyingPlan(unittest.TestCase):
+    def setUp(self):
+        FakeHanwhaCameraClient.cameras = {}
+        FakeHanwhaCameraClient.calls = []
+        self.dir = tempfile.TemporaryDirectory()
+        env = dict(CREDENTIALS, CAMERA_REGISTRY_PATH=os.path.join(self.dir.name, "camera_registry.json"))
+        for p in [
+            mock.patch.object(hanwhacamera, "HanwhaCameraClient", FakeHanwhaCameraClient),
+            mock.patch.dict(os.environ, env),
+        ]:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def test_apply_hanwha_camera_plan(self):
+        FakeHanwhaCameraClient.cameras["10.31.81.11"] = create_fake_camera("10.31.81.11", "left", description="10.31.81.99")
+        camera_plans = [
+            create_camera_plan("10.31.81.10", "top", "configured", []),
+            create_camera_plan("10.31.81.11", "left", "configured", ["sync_device_information"]),
+        ]
+        results = apply_hanwha_camera_plan(camera_plans)
+        self.assertEqual(results[0], camera_plans[0])
+        self.assertEqual(results[1]["actions"], [])
+        self.assertEqual(FakeHanwhaCameraClient.calls, [("update_device_information", "10.31.81.11", "10.31.81.11")])
+
+    def create_plan(self):
+        manifest_camera = utils.CameraObject("top_camera", "hanwha", "XNV-8082R")
+        manifest_camera.set_state("unknown")
+        return {
+            "cameras": [create_camera_plan("10.31.81.10", "top", "factory", ["initialize"])],
+            "manifest_cameras": [vars(manifest_camera)],
+            "datashim": plan_datashim({"default": []}, [manifest_camera], {"default": "7"}),
+        }
+
+    def initialize_camera(self, camera):
+        FakeHanwhaCameraClient.cameras[camera.ip]["initialized"] = True
+        return True, {"sharpness": 12.5, "focused": False}
+
+    def test_apply_plan_with_factory_camera(self):
+        FakeHanwhaCameraClient.cameras["10.31.81.10"] = create_fake_camera("10.31.81.10", "top", initialized=False)
+        api = mock.Mock()
+        # the registry must be saved before the datashim is applied
+        registries = []
+        api.patch_namespaced_config_map.side_effect = \
+            lambda *args: registries.append(utils.load_camera_registry(utils.get_camera_registry_path()))
+        with mock.patch.object(hanwhacamera, "initialize_camera", self.initialize_camera), \
+                mock.patch("camera_provisioner.get_kubernetes_api", return_value=api):
+            plan = self.create_plan()
+            self.assertEqual(apply_plan(plan), 0)
+        self.assertEqual(plan["cameras"][0]["state"], "configured")
+        self.assertTrue(plan["cameras"][0]["note"].startswith("out of focus"))
+        name, namespace, patch = api.patch_namespaced_config_map.call_args.args
+        self.assertEqual((name, namespace), ("waggle-data-config", "default"))
+        self.assertEqual(patch["metadata"]["resourceVersion"], "7")
+        datashim = json.loads(patch["data"]["data-config.json"])
+        self.assertEqual(datashim[0]["match"]["id"], "top_camera")
+        self.assertEqual(datashim[0]["handler"]["args"]["url"], "rtsp://10.31.81.10/profile2/media.smp")
+        self.assertEqual(registries, [{"default": datashim}])
+
+    def test_apply_plan_with_conflict(self):
+        FakeHanwhaCameraClient.cameras["10.31.81.10"] = create_fake_camera("10.31.81.10", "top", initialized=False)
+        api = mock.Mock()
+        api.patch_namespaced_config_map.side_effect = kubernetes.client.rest.ApiException(status=409)
+        with mock.patch.object(hanwhacamera, "initialize_camera", self.initialize_camera), \
+                mock.patch("camera_provisioner.get_kubernetes_api", return_value=api):
+            self.assertEqual(apply_plan(self.create_plan()), 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import kubernetes
+import utils
+from camera_provisioner import apply_plan, plan_datashim
+from datashimguard import CameraRegistry, find_diverged_cameras, guard_configmap, recheck_datashims, restore_cameras, watch_datashim
+
+def create_entry(name, url):
+    return {"handler": {"args": {"url": url}, "type": "video"}, "match": {"id": name}, "name": name}
+
+def create_configmap(resource_version, datashim, namespace="default"):
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": "waggle-data-config", "namespace": namespace, "resourceVersion": resource_version},
+        "data": {"data-config.json": json.dumps(datashim)},
+    }
+
+class FakeAPIServer(BaseHTTPRequestHandler):
+    """Serves watch events of Configmaps and records patches"""
+    events = []
+    watches = []
+    patches = []
+    configmap = None
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if "watch" not in query:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(self.configmap).encode())
+            return
+        self.watches.append(query)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        for event in self.events:
+            self.wfile.write((json.dumps(event) + "\n").encode())
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.patches.append((self.path, body))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(create_configmap("100", [])).encode())
+
+    def log_message(self, *args):
+        pass
+
+class TestDatashimGuard(unittest.TestCase):
+    registry = [create_entry("top_camera", "rtsp://10.31.81.10"), create_entry("left_camera", "rtsp://10.31.81.11")]
+    other = create_entry("bme680", "")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        configuration = kubernetes.client.Configuration()
+        configuration.host = f"http://127.0.0.1:{cls.server.server_port}"
+        cls.api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(configuration))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeAPIServer.watches.clear()
+        FakeAPIServer.patches.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.registry_path = os.path.join(self.dir.name, "camera_registry.json")
+        utils.save_camera_registry(self.registry_path, {"default": self.registry, "ses": self.registry})
+
+    def load_registry(self):
+        registry = CameraRegistry(self.registry_path)
+        registry.reload()
+        return registry
+
+    def test_find_and_restore_cameras(self):
+        changed = create_entry("left_camera", "rtsp://10.31.81.99")
+        datashim = [self.other, changed]
+        diverged = find_diverged_cameras(datashim, self.registry)
+        self.assertEqual(diverged, ["top_camera", "left_camera"])
+        restored = restore_cameras(datashim, self.registry, ["left_camera"])
+        self.assertEqual(restored, [self.other, self.registry[1]])
+
+    def test_restore_diverged_cameras(self):
+        FakeAPIServer.events = [
+            {"type": "ADDED", "object": create_configmap("10", self.registry + [self.other])},
+            {"type": "MODIFIED", "object": create_configmap("20", [self.registry[1], create_entry("bme680", "changed")])},
+            {"type": "BOOKMARK", "object": {"kind": "ConfigMap", "metadata": {"resourceVersion": "30"}}},
+        ]
+        resource_version = watch_datashim(self.api, "default", self.load_registry(), resource_version="5", timeout_seconds=1)
+        self.assertEqual(resource_version, "30")
+        query = FakeAPIServer.watches[0]
+        self.assertEqual(query["fieldSelector"], ["metadata.name=waggle-data-config"])
+        self.assertEqual(query["allowWatchBookmarks"], ["true"])
+        self.assertEqual(query["resourceVersion"], ["5"])
+        self.assertEqual(len(FakeAPIServer.patches), 1)
+        path, patch = FakeAPIServer.patches[0]
+        self.assertEqual(path, "/api/v1/namespaces/default/configmaps/waggle-data-config")
+        self.assertEqual(patch["metadata"]["resourceVersion"], "20")
+        datashim = json.loads(patch["data"]["data-config.json"])
+        self.assertEqual(datashim, [self.registry[1], create_entry("bme680", "changed"), self.registry[0]])
+
+    def test_restart_expired_watch(self):
+        FakeAPIServer.events = [
+            {"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired", "message": "too old"}},
+        ]
+        resource_version = watch_datashim(self.api, "ses", self.load_registry(), resource_version="5", timeout_seconds=1)
+        self.assertIsNone(resource_version)
+        self.assertEqual(FakeAPIServer.patches, [])
+
+    def test_keep_cameras_updated_by_provisioner(self):
+        registry = self.load_registry()
+        # the provisioner saves the registry and then applies the datashim
+        updated = [self.registry[0], create_entry("left_camera", "rtsp://10.31.81.111")]
+        utils.save_camera_registry(self.registry_path, {"default": updated, "ses": self.registry})
+        FakeAPIServer.events = [
+            {"type": "MODIFIED", "object": create_configmap("40", updated + [self.other])},
+        ]
+        watch_datashim(self.api, "default", registry, resource_version="30", timeout_seconds=1)
+        self.assertEqual(FakeAPIServer.patches, [])
+        self.assertEqual(registry.entries["default"], updated)
+        self.assertFalse(registry.reload())
+
+    def test_recheck_datashims(self):
+        FakeAPIServer.configmap = create_configmap("50", [self.registry[0], self.other])
+        restored = recheck_datashims(self.api, ["default"], {"default": self.registry})
+        self.assertEqual(restored, {"default": ["left_camera"]})
+        path, patch = FakeAPIServer.patches[0]
+        self.assertEqual(patch["metadata"]["resourceVersion"], "50")
+        self.assertEqual(json.loads(patch["data"]["data-config.json"]), [self.registry[0], self.other, self.registry[1]])
+
+    def test_not_force_cameras_refused_by_conflict(self):
+        camera = utils.CameraObject("top_camera", "hanwha", "XNV-8082R")
+        camera.set_state("registered")
+        camera.url = "rtsp://10.31.81.20"
+        plan = {
+            "cameras": [],
+            "manifest_cameras": [vars(camera)],
+            "datashim": plan_datashim({"default": [], "ses": []}, [camera], {"default": "7", "ses": "8"}),
+        }
+        def patch_configmap(name, namespace, patch):
+            if namespace == "ses":
+                raise kubernetes.client.rest.ApiException(status=409)
+        api = mock.Mock()
+        api.patch_namespaced_config_map.side_effect = patch_configmap
+        with mock.patch.dict(os.environ, {"CAMERA_REGISTRY_PATH": self.registry_path}), \
+                mock.patch("camera_provisioner.get_kubernetes_api", return_value=api):
+            self.assertEqual(apply_plan(plan), 1)
+        registry = self.load_registry()
+        self.assertEqual(registry.entries["default"], plan["datashim"]["data"])
+        self.assertEqual(registry.entries["ses"], self.registry)
+        # the guard restores the applied camera in default and leaves ses as it was refused
+        FakeAPIServer.configmap = create_configmap("60", self.registry + [self.other])
+        restored = recheck_datashims(self.api, ["default", "ses"], registry.entries)
+        self.assertEqual(restored, {"default": ["top_camera"], "ses": []})
+        self.assertEqual([path for path, _ in FakeAPIServer.patches], ["/api/v1/namespaces/default/configmaps/waggle-data-config"])
+
+    def test_not_recreate_deleted_datashim(self):
+        api = mock.Mock()
+        configmap = kubernetes.client.V1ConfigMap(
+            metadata=kubernetes.client.V1ObjectMeta(name="waggle-data-config", namespace="default"))
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(guard_configmap(api, {"type": "DELETED", "object": configmap}, self.registry), [])
+        self.assertEqual(api.method_calls, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import io
+import json
+import logging
+from eventlog import JSONFormatter, camera_stage, setup_logging, stop_logging, timed_event
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        logging.getLogger().addHandler(self.handler)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+
+    def test_camera_stage(self):
+        @camera_stage("inspect")
+        def inspect(camera):
+            return {"ip": camera["ip"], "mac": "e4:30:22:24:8d:35", "state": "configured"}
+
+        inspect({"ip": "10.31.81.10"})
+        entry = json.loads(JSONFormatter().format(self.records[-1]))
+        self.assertEqual(entry["stage"], "inspect")
+        self.assertEqual(entry["outcome"], "configured")
+        self.assertEqual(entry["camera_ip"], "10.31.81.10")
+        self.assertEqual(entry["camera_mac"], "e4:30:22:24:8d:35")
+        self.assertIn("duration", entry)
+
+    def test_timed_event_error(self):
+        with self.assertRaises(RuntimeError):
+            with timed_event("datashim", namespace="ses"):
+                raise RuntimeError("failed")
+        entry = json.loads(JSONFormatter().format(self.records[-1]))
+        self.assertEqual(entry["outcome"], "error")
+        self.assertEqual(entry["namespace"], "ses")
+
+    def test_skip_events_below_level(self):
+        logging.getLogger().setLevel(logging.WARNING)
+        with timed_event("discover"):
+            pass
+        self.assertEqual(self.records, [])
+
+class TestSetupLogging(unittest.TestCase):
+    def setUp(self):
+        root = logging.getLogger()
+        self.addCleanup(setattr, root, "handlers", list(root.handlers))
+        self.addCleanup(root.setLevel, root.level)
+        self.addCleanup(stop_logging)
+
+    def read_entries(self, stream):
+        stop_logging()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_exception(self):
+        stream = io.StringIO()
+        setup_logging("INFO", "json", stream=stream)
+        try:
+            raise RuntimeError("camera not responding")
+        except RuntimeError:
+            logging.exception("failed to configure %s", "10.31.81.10")
+        entries = self.read_entries(stream)
+        self.assertEqual(entries[0]["message"], "failed to configure 10.31.81.10")
+        self.assertIn("RuntimeError: camera not responding", entries[0]["exception"])
+
+    def test_event(self):
+        stream = io.StringIO()
+        setup_logging("INFO", "json", stream=stream)
+        with timed_event("discover") as event:
+            event["cameras"] = 3
+        entries = self.read_entries(stream)
+        self.assertEqual(entries[0]["stage"], "discover")
+        self.assertEqual(entries[0]["cameras"], 3)
+
+if __name__ == '__main__':
+    unittest.main()
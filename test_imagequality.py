@@ -0,0 +1,43 @@
+import unittest
+import json
+import os
+import tempfile
+import numpy as np
+from PIL import Image, ImageFilter
+from imagequality import record_score, score_image
+
+class TestScoringImage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        checkerboard = (np.indices((1080, 1920)) // 40).sum(axis=0) % 2 * 255
+        self.sharp = Image.fromarray(checkerboard.astype(np.uint8)).convert("RGB")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def save(self, image, name):
+        path = os.path.join(self.dir.name, name)
+        image.save(path, "JPEG")
+        return path
+
+    def test_blurry_image_scores_lower(self):
+        sharp = score_image(self.save(self.sharp, "sharp.jpg"))
+        blurry = score_image(self.save(self.sharp.filter(ImageFilter.GaussianBlur(12)), "blurry.jpg"))
+        self.assertGreater(sharp["sharpness"], 10 * blurry["sharpness"])
+
+    def test_exposure(self):
+        score = score_image(self.save(Image.new("RGB", (1920, 1080)), "dark.jpg"))
+        self.assertEqual(score["sharpness"], 0)
+        self.assertEqual(score["underexposed"], 1)
+        self.assertEqual(score["histogram"][0], 1)
+
+    def test_record_score(self):
+        path = os.path.join(self.dir.name, "focus.jsonl")
+        record_score(path, {"sharpness": 1.0}, ip="10.31.81.10")
+        record_score(path, {"sharpness": 2.0}, ip="10.31.81.10")
+        with open(path) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual([e["sharpness"] for e in entries], [1.0, 2.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
+import os
 import re
 import json
 import pandas
 
 
-def create_dataframe():
+def create_dataframe(records=None):
     """Returns a dataframe representing the camera configuration table
 
     Columns:
@@ -24,12 +25,21 @@ def create_dataframe():
 
     `note` -- a note explaining the state
 
+    Keyword Arguments:
+    --------
+    `records` -- (Optional) a list of dicts to fill the table; keys other than the columns are ignored
+
     Returns:
     --------
-    `cameras` -- a pandas.DataFrame containing empty data with the columns
+    `cameras` -- a pandas.DataFrame containing the records, or empty data, with the columns
     """
+    columns = ["ip", "mac", "orientation", "port", "model", "stream", "state", "note"]
+    if records is None:
+        return pandas.DataFrame([], columns=columns)
     return pandas.DataFrame(
-        [], columns=["ip", "mac", "orientation", "port", "model", "stream", "state", "note"]
+        [{c: r.get(c, "") for c in columns} for r in records],
+        columns=columns,
+        index=[r.get("ip", "") for r in records],
     )
 
 
@@ -52,6 +62,31 @@ def load_node_manifest(node_manifest_path):
         return json.load(file)
 
 
+def get_camera_registry_path():
+    return os.getenv("CAMERA_REGISTRY_PATH", "/data/camera_registry.json")
+
+
+def save_camera_registry(registry_path, registry:dict):
+    """Saves datashim entries of cameras as the last known-good camera registry
+
+    Keyword Arguments:
+    --------
+    `registry_path` -- a path to the camera registry
+
+    `registry` -- a dict of namespace and a list of datashim entries of cameras applied to it
+    """
+    with open(registry_path, "w") as file:
+        json.dump(registry, file, indent=4)
+
+
+def load_camera_registry(registry_path) -> dict:
+    """Returns datashim entries of cameras per namespace from the camera registry; empty if not exists"""
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, "r") as file:
+        return json.load(file)
+
+
 def does_networkswitch_exist(node_manifest_path) -> bool:
     manifest = load_node_manifest(node_manifest_path)
     resources = manifest.get("resources", None)